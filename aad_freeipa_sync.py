@@ -4,16 +4,21 @@
 
 
 import os
+import sys
 import time
+import signal
+import contextvars
+import concurrent.futures
 # Import functions from src/aad.py
 import src.aad
 import src.logger
-import src.freeIPA
 import src.configure
-import src.sync_user
+import src.metrics
+import src.listener
+import src.scheduler
+import src.target
 
-from src.sendmail import send_email
-from datetime import datetime
+import src.sendmail
 import argparse
 
 sample_config = """
@@ -23,19 +28,34 @@ client_secret = <azure application client id>
 tenant_id = <azure tenant id>
 scope = https://graph.microsoft.com/.default
 token_cache = .token_cache
+timeout = <graph request timeout in seconds, default 60>
+max_retries = <graph retries on throttling, default 5>
+concurrency = <parallel graph workers for group crawls, default 4>
+rate_limit = <optional max graph requests per second>
 
 [freeipa]
-server = <freeipa server ip or hostname>
+server = <freeipa server ip or hostname, several separated by comma for failover>
 realm = <freeipa realm>
 user = cn=directory manager
 password = <directory manager password>
 basedn = dc=<your dc1>,dc=<your dc2>
+id_allocator = <highwater or range, default highwater>
+id_range = <optional uid/gid range for range mode, e.g. 200000-299999>
+id_block_size = <ids reserved per block, default 100>
 
 [newuser]
 password = <new user default password>
 
 [sync]
 interval = <sync period>
+mode = <full or delta, default full>
+groups = <optional azure ad groups to mirror into freeipa, separate by comma>
+jitter = <random start delay as a fraction of the interval, default 0.1>
+max_backoff = <longest wait in seconds after repeated failures, default 3600>
+shards = <worker processes sharing the user sync, default 1>
+deprovision = <none, disable (lock) or preserve (lock and move deleted users to preserved), default none>
+lock_dir = <directory for the lock file preventing overlapping runs, default /run/lock or the temp directory, shared by every install on the host>
+max_parallel_targets = <targets synced at the same time, default 2>
 
 [mail]
 recipients = <email recipients, separate by comma>
@@ -43,11 +63,49 @@ server = smtp.office365.com
 port = 587
 user = <email account used to send>
 password = <account password or application password>
+digest_window = <seconds to collect reports into one email, default 0>
+timeout = <smtp timeout in seconds, default 30>
+spool_dir = <directory for undelivered reports, default mail_spool next to the token cache>
 
 [logging]
 level = INFO        
+format = <text or json for one JSON object per line with the cycle id, default text>
+
+[metrics]
+port = <optional local port serving /metrics>
+textfile = <optional path for the node_exporter textfile collector>
+
+[listener]
+notification_url = <optional public https url of this host's /notifications, enables change notifications>
+port = <local port for the notification receiver, default 8765>
+client_state = <optional shared secret echoed back in every notification>
+
+# Several tenant/realm pairs can be synced by one instance: give each target
+# an [azure_ad:name] and a [freeipa:name] section with the same keys as above,
+# and leave out the bare [azure_ad] and [freeipa]. Any other section can be
+# overridden per target the same way, e.g. [sync:name]. Each target keeps its
+# state under targets/<name>; the listener is only used with a single target.
+#
+# [azure_ad:contoso]
+# client_id = <azure application client id>
+# ...
+# token_cache = .token_cache.contoso
+#
+# [freeipa:contoso]
+# server = <freeipa server of this target>
+# ...
 """
 
+# Apply a reloaded configuration to the running targets, notifier and
+# logger. Azure AD, FreeIPA, metrics and listener settings need a restart.
+def apply_config(config, targets, notifier):
+    for target in targets:
+        target.reconfigure(config)
+    notifier.recipients = config.get('mail', 'recipients')
+    notifier.digest_window = config.get('mail', 'digest_window')
+    notifier.timeout = config.get('mail', 'timeout')
+    src.logger.logger.setLevel(config.get('logging', 'level'))
+
 # main function
 def main():
 
@@ -71,49 +129,98 @@ def main():
     config = src.configure.Config(config_file_path)
 
     # prepare logger
-    src.logger.logger = src.logger.get_logger(os.path.join(root_dir,"log"))
-
-    # get the Azure AD access token
-    token_cache_file = os.path.join(root_dir, config.get('azure_ad', 'token_cache'))
-
-    access_token = src.aad.get_aad_access_token(
-        token_cache_file    = token_cache_file,
-        tenant_id           = config.get('azure_ad', 'tenant_id'),
-        client_id           = config.get('azure_ad', 'client_id'),
-        client_secret       = config.get('azure_ad', 'client_secret'),
-        authority           = config.get('azure_ad', 'authority'),
-        scopes              = [config.get('azure_ad', 'scope')]
+    src.logger.logger = src.logger.get_logger(
+        os.path.join(root_dir,"log"),
+        level = config.get('logging', 'level'),
+        json_format = config.get('logging', 'format') == 'json'
     )
 
-    while True:
+    # one target per [azure_ad:name]/[freeipa:name] pair, or the single
+    # unnamed one; only one sync may run against a FreeIPA at a time
+    targets = src.target.get_targets(config, root_dir)
+    for target in targets:
         try:
-            new_users = src.sync_user.sync_users(config, access_token)
-            if new_users:
-                report = "New Users Created in FreeIPA:\n\n"
-                report += "{:<12} {:<20} {:<40} {:<10}\n".format("UIDNumber", "UID", "Email", "Password")
-                report += "-" * 84 + "\n"
-                for user in new_users:
-                    report += "{:<12} {:<20} {:<40} {:<10}\n".format(user['uidNumber'], user['uid'], user['mail'], user['password'])
-                
-                timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-                print (report)
-                send_email(
-                    server = config.get('mail', 'server'), 
-                    port = config.get('mail', 'port'), 
-                    user = config.get('mail', 'user'), 
-                    password = config.get('mail', 'password'), 
-                    subject = f"AAD to FreeIPA Sync Report - {timestamp}",
-                    body   = report,
-                    recipients = config.get('mail', 'recipients').split(','))
-            else:
-                src.logger.logger.info("No new users found.")
+            target.open()
+        except src.scheduler.SchedulerError as e:
+            src.logger.logger.error(str(e))
+            for target in targets:
+                target.close()
+            sys.exit(1)
         except Exception as e:
-            src.logger.logger.error(f"An error occurred: {e}")
-
-        # Wait for 5 minutes before running again
-        time.sleep(int(config.get('sync', 'interval')))
+            # the other targets go ahead; this one retries on its own schedule
+            src.logger.logger.error(f"Could not start target {target.label}, retrying with its next cycle: {e}")
+
+    # optional Prometheus metrics, on a local port and/or a textfile
+    metrics_port = config.get('metrics', 'port')
+    metrics_textfile = config.get('metrics', 'textfile')
+    if metrics_port:
+        src.metrics.start_http_server(metrics_port)
+    # reports are mailed from a background thread
+    notifier = src.sendmail.get_notifier(config, root_dir).start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # the configuration is reloaded between cycles on SIGHUP or when the file changes
+    reloader = src.configure.ConfigReloader(config)
+    signal.signal(signal.SIGHUP, reloader.request)
+
+    # optional listener for Graph change notifications; the interval then
+    # only paces the full reconcile
+    listener = None
+    if config.get('listener', 'notification_url'):
+        if len(targets) > 1:
+            src.logger.logger.warning("Change notifications are only supported with a single target, ignoring [listener]")
+        elif targets[0].client is None:
+            src.logger.logger.error(f"Change notifications disabled, target {targets[0].label} could not be set up")
+        else:
+            listener = src.listener.NotificationListener(
+                port=config.get('listener', 'port'),
+                client_state=config.get('listener', 'client_state')
+            ).start()
+            subscription = src.listener.Subscription(targets[0].client, config.get('listener', 'notification_url'),
+                                                     listener.client_state)
+
+    # targets due for a sync run side by side, each at most once at a time
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=config.get('sync', 'max_parallel_targets'),
+                                                     thread_name_prefix='target')
+    running = {}
+    try:
+        while True:
+            # Wait for the next sync, handling change notifications meanwhile
+            next_run = min(target.next_run for target in targets if target not in running.values()) \
+                if len(running) < len(targets) else None
+            if listener and not running:
+                src.listener.serve_until(listener, subscription, next_run,
+                                         lambda object_ids: targets[0].handle_changes(notifier, object_ids))
+            elif running:
+                timeout = None if next_run is None else max(0, next_run - time.monotonic())
+                done, _ = concurrent.futures.wait(running, timeout=timeout,
+                                                  return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    del running[future]
+                if done and metrics_textfile:
+                    src.metrics.write_textfile(metrics_textfile)
+            else:
+                time.sleep(max(0, next_run - time.monotonic()))
+
+            new_config = reloader.check()
+            if new_config:
+                config = new_config
+                apply_config(config, targets, notifier)
+
+            now = time.monotonic()
+            for target in targets:
+                if target.next_run <= now and target not in running.values():
+                    # copy_context so each target's metrics label and cycle id stay its own
+                    context = contextvars.copy_context()
+                    running[executor.submit(context.run, target.run_scheduled, notifier)] = target
+    finally:
+        if listener:
+            subscription.delete()
+            listener.stop()
+        executor.shutdown(wait=True, cancel_futures=True)
+        notifier.stop()
+        for target in targets:
+            target.close()
+        src.logger.stop_logging()
 
 if __name__ == "__main__":
-    main()
-
+    main()
\ No newline at end of file
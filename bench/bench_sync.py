@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+# Azure AD user/group FreeIPA sync utility
+# Copyright (c) 2024 Jackson Tong, Creekside Networks LLC.
+#
+# Offline benchmark of the sync cycle. Graph is served by bench/fake_graph.py
+# and FreeIPA by an ldap3 MOCK_SYNC/MOCK_ASYNC directory pre-seeded with the
+# tenant's users, so no real tenant or IPA server is touched. Each tenant size
+# runs in its own process so the peak RSS figures don't bleed into each other.
+#
+#   python bench/bench_sync.py --users 1000 10000 100000
+
+import os
+import sys
+import json
+import time
+import inspect
+import logging
+import argparse
+import resource
+import tempfile
+import subprocess
+from collections import Counter, defaultdict
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import ldap3
+
+import src.aad
+import src.graph
+import src.state
+import src.logger
+import src.idalloc
+import src.freeIPA
+import src.configure
+import src.sync_user
+import src.sync_group
+import src.group_resolver
+import src.deprovision
+from fake_graph import FakeTenant, FakeGraphServer
+
+BASEDN = 'dc=bench,dc=test'
+USERS_DN = f'cn=users,cn=accounts,{BASEDN}'
+GROUPS_DN = f'cn=groups,cn=accounts,{BASEDN}'
+MANAGER_DN = 'cn=directory manager'
+MANAGER_PASSWORD = 'bench'
+FIRST_ID = 10000
+
+CONFIG = """
+[azure_ad]
+client_id = bench
+client_secret = bench
+tenant_id = bench
+scope = https://graph.microsoft.com/.default
+token_cache = .token_cache
+concurrency = {concurrency}
+
+[freeipa]
+server = mock
+realm = BENCH.TEST
+user = {manager_dn}
+password = {manager_password}
+basedn = {basedn}
+
+[newuser]
+password = bench
+
+[sync]
+interval = 300
+groups = {groups}
+deprovision = preserve
+
+[mail]
+server = localhost
+port = 25
+user = bench
+password = bench
+
+[logging]
+level = WARNING
+"""
+
+LDAP_OPS = Counter()
+PHASES = defaultdict(float)
+
+# ldap3 connection that counts the operations it sends
+class CountingConnection(ldap3.Connection):
+
+    def search(self, *args, **kwargs):
+        LDAP_OPS['search'] += 1
+        return super().search(*args, **kwargs)
+
+    def add(self, *args, **kwargs):
+        LDAP_OPS['add'] += 1
+        return super().add(*args, **kwargs)
+
+    def modify(self, *args, **kwargs):
+        LDAP_OPS['modify'] += 1
+        return super().modify(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        LDAP_OPS['delete'] += 1
+        return super().delete(*args, **kwargs)
+
+    def modify_dn(self, *args, **kwargs):
+        LDAP_OPS['modify_dn'] += 1
+        return super().modify_dn(*args, **kwargs)
+
+# FreeIPAConnection bound to the shared mock directory instead of a server
+class MockFreeIPAConnection(src.freeIPA.FreeIPAConnection):
+
+    def __init__(self, server):
+        super().__init__('mock', MANAGER_DN, MANAGER_PASSWORD)
+        self.server = server
+
+    def bind(self, client_strategy=ldap3.SYNC):
+        strategy = ldap3.MOCK_ASYNC if client_strategy == ldap3.ASYNC else ldap3.MOCK_SYNC
+        conn = CountingConnection(self.server, user=MANAGER_DN, password=MANAGER_PASSWORD, client_strategy=strategy)
+        conn.bind()
+        return conn
+
+    # the mock directory has no rootDSE to read
+    def is_alive(self):
+        return self.conn is not None and self.conn.bound
+
+    def async_alive(self):
+        return self.async_conn is not None and self.async_conn.bound
+
+# Seed the mock directory with the first `count` users of the tenant
+def seed_directory(tenant, count):
+    server = ldap3.Server('mock', get_info=ldap3.NONE)
+    conn = ldap3.Connection(server, user=MANAGER_DN, password=MANAGER_PASSWORD, client_strategy=ldap3.MOCK_SYNC)
+    conn.strategy.add_entry(MANAGER_DN, {'userPassword': MANAGER_PASSWORD, 'sn': 'manager'})
+    # the containers FreeIPA always has, searched as base objects
+    for container in (USERS_DN, GROUPS_DN):
+        conn.strategy.add_entry(container, {'objectClass': ['top', 'nsContainer'], 'cn': container.split(',')[0][3:]})
+    # the DNA plugin config ids are claimed from, past the seeded users
+    conn.strategy.add_entry(src.idalloc.DNA_POSIX_IDS_DN, {
+        'objectClass': ['top', 'extensibleObject'], 'cn': 'Posix IDs',
+        'dnaNextValue': str(FIRST_ID + count), 'dnaMaxValue': str(FIRST_ID + 10 ** 7),
+    })
+    for n, user in enumerate(list(tenant.users.values())[:count]):
+        uid = src.sync_user.aad_uid(user)
+        conn.strategy.add_entry(f"uid={uid},{USERS_DN}", {
+            'objectClass': ['top', 'person', 'posixAccount'],
+            'uid': uid,
+            'cn': user['displayName'],
+            'givenName': user['givenName'],
+            'sn': user['surname'],
+            'mail': user['mail'],
+            'uidNumber': str(FIRST_ID + n),
+            'gidNumber': str(FIRST_ID + n),
+        })
+    return server
+
+# Replace module.name with a wrapper adding its run time to PHASES[phase];
+# for generators only the time spent producing items is counted
+def timed(module, name, phase):
+    func = getattr(module, name)
+    if inspect.isgeneratorfunction(func):
+        def wrapper(*args, **kwargs):
+            iterator = func(*args, **kwargs)
+            while True:
+                started = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    PHASES[phase] += time.perf_counter() - started
+                yield item
+    else:
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                PHASES[phase] += time.perf_counter() - started
+    setattr(module, name, wrapper)
+
+def instrument():
+    timed(src.aad, 'iter_aad_users', 'graph_users')
+    timed(src.aad, 'iter_aad_users_delta', 'graph_users')
+    timed(src.group_resolver, 'resolve_group_users', 'graph_groups')
+    timed(src.freeIPA, 'load_user_index', 'ldap_index')
+    timed(src.freeIPA, 'create_users', 'ldap_create')
+    timed(src.freeIPA, 'update_users', 'ldap_update')
+    timed(src.idalloc, 'get_id_allocator', 'id_alloc')
+    timed(src.sync_group, 'sync_groups', 'group_sync')
+    timed(src.deprovision, 'deprovision_users', 'deprovision')
+
+def run_cycle(name, graph, run):
+    LDAP_OPS.clear()
+    PHASES.clear()
+    graph.requests.clear()
+    started = time.perf_counter()
+    new_users = run()
+    wall = time.perf_counter() - started
+    return {
+        'cycle': name,
+        'wall': round(wall, 3),
+        'new_users': len(new_users),
+        'phases': {phase: round(seconds, 3) for phase, seconds in sorted(PHASES.items())},
+        'graph_requests': dict(graph.requests),
+        'ldap_ops': dict(LDAP_OPS),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+# Run the cycles for one tenant size and print one JSON line per cycle
+def run_worker(args):
+    logger = logging.getLogger('bench')
+    logger.addHandler(logging.StreamHandler(sys.stderr))
+    logger.setLevel(logging.WARNING)
+    src.logger.logger = logger
+    instrument()
+
+    groups = max(10, args.users // 100)
+    tenant = FakeTenant(args.users, groups=groups, nested=args.nested, seed=args.seed)
+    seeded = args.users - max(1, args.users // 100)
+    directory = seed_directory(tenant, seeded)
+    graph = FakeGraphServer(tenant, page_size=args.page_size, latency=args.latency,
+                            throttle_rate=args.throttle, seed=args.seed).start()
+
+    with tempfile.TemporaryDirectory() as state_dir:
+        config_file = os.path.join(state_dir, 'config.ini')
+        group_names = ','.join(f"Bench Group {n}" for n in range(min(groups, args.groups)))
+        with open(config_file, 'w') as f:
+            f.write(CONFIG.format(concurrency=args.concurrency, manager_dn=MANAGER_DN,
+                                  manager_password=MANAGER_PASSWORD, basedn=BASEDN, groups=group_names))
+        config = src.configure.Config(config_file)
+        client = src.graph.GraphClient('bench', base_url=graph.base_url, pool_size=max(10, args.concurrency))
+        ipa = MockFreeIPAConnection(directory)
+        state = src.state.StateStore(os.path.join(state_dir, 'bench.db'))
+        delta_link_file = os.path.join(state_dir, '.token_cache.delta')
+
+        def full():
+            new_users = src.sync_user.sync_users(config, client, ipa, state, None, state_dir)
+            src.sync_group.sync_groups(config, client, ipa, state)
+            return new_users
+
+        def incremental():
+            new_users = src.sync_user.sync_users(config, client, ipa, state, delta_link_file, state_dir)
+            src.sync_group.sync_groups(config, client, ipa, state)
+            return new_users
+
+        cycles = [
+            ('full-cold', full),
+            ('full-warm', full),
+            ('delta-baseline', incremental),
+        ]
+        for name, run in cycles:
+            print(json.dumps(dict(run_cycle(name, graph, run), users=args.users)), flush=True)
+
+        tenant.mutate(changed=max(1, args.users // 100), added=max(1, args.users // 200),
+                      removed=max(1, args.users // 1000), disabled=max(1, args.users // 1000), regrouped=2)
+        print(json.dumps(dict(run_cycle('delta-incremental', graph, incremental), users=args.users)), flush=True)
+
+        state.close()
+        ipa.close()
+    graph.shutdown()
+
+def print_table(results):
+    print(f"{'users':>8} {'cycle':<18} {'wall s':>8} {'new':>6} {'graph req':>9} {'ldap ops':>8} {'rss MB':>8}  phases")
+    for r in results:
+        phases = ' '.join(f"{phase}={seconds:.2f}" for phase, seconds in r['phases'].items())
+        print(f"{r['users']:>8} {r['cycle']:<18} {r['wall']:>8.2f} {r['new_users']:>6} "
+              f"{sum(r['graph_requests'].values()):>9} {sum(r['ldap_ops'].values()):>8} {r['peak_rss_mb']:>8.1f}  {phases}")
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline Azure AD to FreeIPA sync benchmark')
+    parser.add_argument('--users', type=int, nargs='+', default=[1000, 10000, 100000], help='Tenant sizes to run')
+    parser.add_argument('--page-size', type=int, default=999, help='Graph page size')
+    parser.add_argument('--latency', type=float, default=0.0, help='Graph latency per request in seconds')
+    parser.add_argument('--throttle', type=float, default=0.0, help='Fraction of Graph requests answered with 429')
+    parser.add_argument('--groups', type=int, default=20, help='Number of groups to mirror')
+    parser.add_argument('--concurrency', type=int, default=4, help='Graph workers for group crawls')
+    parser.add_argument('--nested', type=int, default=2, help='Nested groups per group')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='Print raw JSON results')
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        args.users = args.users[0]
+        run_worker(args)
+        return
+
+    results = []
+    for users in args.users:
+        command = [sys.executable, os.path.abspath(__file__), '--worker', '--users', str(users),
+                   '--page-size', str(args.page_size), '--latency', str(args.latency),
+                   '--throttle', str(args.throttle), '--groups', str(args.groups),
+                   '--concurrency', str(args.concurrency), '--nested', str(args.nested),
+                   '--seed', str(args.seed)]
+        output = subprocess.run(command, check=True, stdout=subprocess.PIPE, text=True).stdout
+        results.extend(json.loads(line) for line in output.splitlines() if line.strip())
+
+    if args.json:
+        for result in results:
+            print(json.dumps(result))
+    else:
+        print_table(results)
+
+if __name__ == "__main__":
+    main()
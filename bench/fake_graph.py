@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# Azure AD user/group FreeIPA sync utility
+# Copyright (c) 2024 Jackson Tong, Creekside Networks LLC.
+#
+# Local stand-in for the Microsoft Graph endpoints used by the sync:
+# /users, /users/delta, /groups, /groups/delta, /groups/{id}/members,
+# /groups/{id}/transitiveMembers/<type> and /$batch, with configurable page
+# size, latency and 429 injection.
+
+import json
+import time
+import random
+import threading
+from collections import Counter
+from urllib.parse import urlsplit, parse_qs, urlencode
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+class FakeTenant:
+
+    def __init__(self, users, groups=0, members_per_group=50, nested=0, seed=1):
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+        self.version = 0
+        self.users = {}
+        self.changed = {}   # object id -> version it last changed in
+        self.removed = {}   # object id -> version it was removed in
+        self.groups_changed = {}   # group id -> version its members last changed in
+        for n in range(users):
+            self.add_user()
+        ids = list(self.users)
+        self.groups = {}
+        for n in range(groups):
+            group_id = f"group-{n:06d}"
+            members = self.random.sample(ids, min(members_per_group, len(ids)))
+            self.groups[group_id] = {'id': group_id, 'displayName': f"Bench Group {n}", 'members': members}
+        # with nested > 0 the groups form a tree: group n also has groups
+        # nested * n + 1 ... nested * n + nested as members
+        for n in range(groups if nested else 0):
+            for child in range(nested * n + 1, min(nested * n + nested + 1, groups)):
+                self.groups[f"group-{n:06d}"]['members'].append(f"group-{child:06d}")
+
+    def add_user(self):
+        n = len(self.users) + len(self.removed)
+        object_id = f"user-{n:08d}"
+        self.users[object_id] = {
+            'id': object_id,
+            'userPrincipalName': f"bench{n:08d}@example.com",
+            'givenName': f"Given{n}",
+            'surname': f"Surname{n}",
+            'displayName': f"Bench User {n}",
+            'mail': f"bench{n:08d}@example.com",
+            'accountEnabled': True,
+        }
+        self.changed[object_id] = self.version
+        return object_id
+
+    # Change, add, disable and remove users, as the incremental cycles will see them
+    def mutate(self, changed=0, added=0, removed=0, disabled=0, regrouped=0):
+        with self.lock:
+            self.version += 1
+            ids = list(self.users)
+            for object_id in self.random.sample(ids, min(changed, len(ids))):
+                self.users[object_id]['displayName'] += ' (renamed)'
+                self.changed[object_id] = self.version
+            for object_id in self.random.sample(ids, min(disabled, len(ids))):
+                self.users[object_id]['accountEnabled'] = False
+                self.changed[object_id] = self.version
+            for _ in range(added):
+                self.add_user()
+            for object_id in self.random.sample(list(self.users), min(removed, len(self.users))):
+                del self.users[object_id]
+                del self.changed[object_id]
+                self.removed[object_id] = self.version
+                for group in self.groups.values():
+                    if object_id in group['members']:
+                        group['members'].remove(object_id)
+                        self.groups_changed[group['id']] = self.version
+            ids = list(self.users)
+            for group_id in self.random.sample(list(self.groups), min(regrouped, len(self.groups))):
+                self.groups[group_id]['members'].append(self.random.choice(ids))
+                self.groups_changed[group_id] = self.version
+
+    def delta_since(self, version):
+        with self.lock:
+            items = [dict(self.users[object_id]) for object_id, v in self.changed.items() if v >= version]
+            items += [{'id': object_id, '@removed': {'reason': 'deleted'}}
+                      for object_id, v in self.removed.items() if v >= version and version > 0]
+            return items, self.version + 1
+
+    def group_delta_since(self, version):
+        with self.lock:
+            items = [{'id': group_id, 'members@delta': []}
+                     for group_id, v in self.groups_changed.items() if v >= version]
+            return items, self.version + 1
+
+    # Members of a group; with transitive those of its nested groups too,
+    # each group entered once so cycles end
+    def group_members(self, group_id, transitive=False):
+        with self.lock:
+            members = []
+            seen = {group_id}
+            stack = [group_id]
+            while stack:
+                for object_id in self.groups[stack.pop()]['members']:
+                    if object_id in self.users:
+                        members.append(dict(self.users[object_id], **{'@odata.type': '#microsoft.graph.user'}))
+                    elif object_id in self.groups and object_id not in seen:
+                        members.append({'id': object_id, '@odata.type': '#microsoft.graph.group',
+                                        'displayName': self.groups[object_id]['displayName']})
+                        if transitive:
+                            seen.add(object_id)
+                            stack.append(object_id)
+            if transitive:
+                # a user reached through several groups is listed once
+                members = list({member['id']: member for member in members}.values())
+            return members
+
+class FakeGraphServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, tenant, page_size=100, latency=0.0, throttle_rate=0.0, seed=1):
+        super().__init__(('127.0.0.1', 0), FakeGraphHandler)
+        self.tenant = tenant
+        self.page_size = page_size
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.random = random.Random(seed)
+        self.requests = Counter()
+        self.counter_lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1.0"
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name='fake-graph', daemon=True)
+        thread.start()
+        return self
+
+    def count(self, kind):
+        with self.counter_lock:
+            self.requests[kind] += 1
+
+    def throttled(self):
+        with self.counter_lock:
+            return self.throttle_rate and self.random.random() < self.throttle_rate
+
+    def page(self, items, path, query, skip):
+        size = int(query.get('$top', [self.page_size])[0])
+        size = min(size, self.page_size)
+        body = {'value': items[skip:skip + size]}
+        if skip + size < len(items):
+            query = dict(query)
+            query['$skiptoken'] = [str(skip + size)]
+            body['@odata.nextLink'] = f"{self.base_url}{path}?{urlencode(query, doseq=True, safe='$,')}"
+        return body
+
+    # Answer one GET; returns (status, body)
+    def get(self, url):
+        parts = urlsplit(url)
+        path = parts.path[len('/v1.0'):] if parts.path.startswith('/v1.0') else parts.path
+        query = parse_qs(parts.query)
+        skip = int(query.get('$skiptoken', ['0'])[0])
+        tenant = self.tenant
+
+        if self.throttled():
+            self.count('throttled')
+            return 429, {'error': {'code': 'TooManyRequests'}}
+
+        if path == '/users':
+            self.count('users')
+            with tenant.lock:
+                users = list(tenant.users.values())
+            return 200, self.page(users, path, query, skip)
+
+        if path == '/users/delta':
+            self.count('users/delta')
+            version = int(query.get('$deltatoken', ['0'])[0])
+            items, next_version = tenant.delta_since(version)
+            query.pop('$deltatoken', None)
+            body = self.page(items, path, query, skip)
+            if '@odata.nextLink' in body:
+                body['@odata.nextLink'] += f"&$deltatoken={version}"
+            else:
+                body['@odata.deltaLink'] = f"{self.base_url}{path}?$deltatoken={next_version}"
+            return 200, body
+
+        if path == '/groups':
+            self.count('groups')
+            groups = [{'id': g['id'], 'displayName': g['displayName']} for g in tenant.groups.values()]
+            name_filter = query.get('$filter', [None])[0]
+            if name_filter:
+                name = name_filter.split("eq '", 1)[1].rstrip("'").replace("''", "'")
+                groups = [g for g in groups if g['displayName'] == name]
+            return 200, self.page(groups, path, query, skip)
+
+        if path == '/groups/delta':
+            self.count('groups/delta')
+            token = query.pop('$deltatoken', ['0'])[0]
+            if token == 'latest':
+                return 200, {'value': [], '@odata.deltaLink': f"{self.base_url}{path}?$deltatoken={tenant.version + 1}"}
+            items, next_version = tenant.group_delta_since(int(token))
+            body = self.page(items, path, query, skip)
+            if '@odata.nextLink' in body:
+                body['@odata.nextLink'] += f"&$deltatoken={token}"
+            else:
+                body['@odata.deltaLink'] = f"{self.base_url}{path}?$deltatoken={next_version}"
+            return 200, body
+
+        if path.startswith('/groups/') and ('/members' in path or '/transitiveMembers' in path):
+            relationship = path.split('/')[3]
+            self.count(relationship)
+            group_id = path.split('/')[2]
+            if group_id not in tenant.groups:
+                return 404, {'error': {'code': 'Request_ResourceNotFound'}}
+            members = tenant.group_members(group_id, transitive=relationship == 'transitiveMembers')
+            cast = path.split('/')[4] if len(path.split('/')) > 4 else None
+            if cast:
+                members = [member for member in members if member['@odata.type'] == f"#{cast}"]
+            return 200, self.page(members, path, query, skip)
+
+        return 404, {'error': {'code': 'BadRequest', 'message': f"unsupported path {path}"}}
+
+class FakeGraphHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body, headers=None):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        if status == 429:
+            self.send_header('Retry-After', '0')
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        status, body = self.server.get(self.path)
+        self.reply(status, body)
+
+    def do_POST(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        if not self.path.endswith('/$batch'):
+            self.reply(404, {'error': {'code': 'BadRequest'}})
+            return
+        self.server.count('batch')
+        responses = []
+        for item in request.get('requests', []):
+            status, body = self.server.get(f"/v1.0{item['url']}")
+            headers = {'Retry-After': '0'} if status == 429 else {}
+            responses.append({'id': item['id'], 'status': status, 'headers': headers, 'body': body})
+        self.reply(200, {'responses': responses})
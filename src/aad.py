@@ -23,107 +23,354 @@
 
 
 import os
+import time
+import threading
+import contextvars
+from   urllib.parse import quote
+from   concurrent.futures import ThreadPoolExecutor
 import msal
-import requests
 from   ldap3 import Server, Connection, ALL, SUBTREE, MODIFY_REPLACE
 import src.logger
+import src.graph
+import src.metrics
+
+# Access tokens are refreshed this many seconds before they expire
+TOKEN_REFRESH_MARGIN = 300
+
+# Azure AD access token provider for the Graph client. The token is kept in
+# memory with its expiry and refreshed in the background before it expires;
+# the MSAL cache file is rewritten atomically and only when MSAL changed it.
+class TokenProvider:
+
+    def __init__(self, token_cache_file, tenant_id, client_id, client_secret, scopes,
+                 refresh_margin=TOKEN_REFRESH_MARGIN):
+        self.token_cache_file = token_cache_file
+        self.scopes = scopes
+        self.refresh_margin = refresh_margin
+        self.cache = msal.SerializableTokenCache()
+        if os.path.exists(token_cache_file):
+            with open(token_cache_file, 'r') as f:
+                self.cache.deserialize(f.read())
+
+        self.authority = str(f"https://login.microsoftonline.com/{tenant_id}")
+        self.client_id = client_id
+        self.client_secret = client_secret
+        # built on first use: MSAL contacts the authority when it is created
+        self.app = None
+        self.lock = threading.RLock()
+        self.access_token = None
+        self.expires_at = 0
+        self.timer = None
+        self.running = False
+
+    # Get a token from MSAL; force skips the cached one (MSAL would otherwise
+    # keep returning it until it is almost expired)
+    def refresh(self, force=False):
+        with self.lock:
+            if force:
+                self.drop_cached_tokens()
+            app = self.application()
+            result = app.acquire_token_silent(scopes=self.scopes, account=None)
+            if not result:
+                result = app.acquire_token_for_client(scopes=self.scopes)
+            if 'access_token' not in result:
+                error_message = result.get('error_description', 'No error description available')
+                src.logger.logger.error(f"Could not obtain access token: {error_message}")
+                raise src.graph.GraphError(f"Could not obtain access token: {error_message}", 401)
+
+            self.access_token = result['access_token']
+            self.expires_at = time.time() + int(result.get('expires_in', 3600))
+            src.logger.logger.info("Access token obtained successfully")
+            self.save_cache()
+            self.schedule()
+            return self.access_token
+
+    def application(self):
+        if self.app is None:
+            try:
+                self.app = msal.ConfidentialClientApplication(self.client_id, authority=self.authority,
+                                                              client_credential=self.client_secret,
+                                                              token_cache=self.cache)
+            except Exception as e:
+                raise src.graph.GraphError(f"Could not set up Azure AD authentication: {e}")
+        return self.app
+
+    # Current token, refreshed first if it is about to expire
+    def get(self):
+        with self.lock:
+            if self.access_token is None:
+                return self.refresh()
+            if time.time() >= self.expires_at - self.refresh_margin:
+                return self.refresh(force=True)
+            return self.access_token
+
+    # Drop the current token (e.g. after a 401) so the next get() fetches a new one
+    def invalidate(self):
+        with self.lock:
+            self.drop_cached_tokens()
+            self.access_token = None
+
+    def drop_cached_tokens(self):
+        for token in self.cache.find(msal.TokenCache.CredentialType.ACCESS_TOKEN):
+            self.cache.remove_at(token)
+
+    def save_cache(self):
+        if not self.cache.has_state_changed:
+            return
+        tmp_file = f"{self.token_cache_file}.tmp"
+        with open(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            f.write(self.cache.serialize())
+        os.replace(tmp_file, self.token_cache_file)
+        self.cache.has_state_changed = False
+
+    # Background refresh, scheduled refresh_margin before expiry
+    def start(self):
+        self.running = True
+        self.get()
+
+    def schedule(self):
+        if not self.running:
+            return
+        if self.timer:
+            self.timer.cancel()
+        delay = max(self.expires_at - self.refresh_margin - time.time(), 30)
+        self.timer = threading.Timer(delay, self.background_refresh)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def background_refresh(self):
+        try:
+            self.refresh(force=True)
+        except Exception as e:
+            # get() will retry on demand; try again in a little while
+            src.logger.logger.error(f"Background token refresh failed: {e}")
+            with self.lock:
+                self.expires_at = min(self.expires_at, time.time() + self.refresh_margin + 60)
+                self.schedule()
+
+    def stop(self):
+        self.running = False
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
 
 # Authenticate to Azure AD
 def get_aad_access_token(token_cache_file, tenant_id, client_id, client_secret, authority, scopes):
-    cache = msal.SerializableTokenCache()
-    if os.path.exists(token_cache_file):
-        cache.deserialize(open(token_cache_file, 'r').read())
-
-    authority = str(f"https://login.microsoftonline.com/{tenant_id}")
-    #print(f"Authority: {authority}")
-    #print(f"Client ID: {client_id}")
-    #print(f"Client Secret: {client_secret}")
-    #print(f"Scope: {scope}")
-
-    app = msal.ConfidentialClientApplication(client_id, authority=authority, client_credential=client_secret, token_cache=cache)
-    result = app.acquire_token_silent(scopes=scopes, account=None)
-    if not result:
-        result = app.acquire_token_for_client(scopes=scopes)
-    if 'access_token' in result:
-        src.logger.logger.info("Access token obtained successfully")
-        with open(token_cache_file, 'w') as f:
-            f.write(cache.serialize())
-        return result['access_token']
-    else:
-        error_message = result.get('error_description', 'No error description available')
-        src.logger.logger.error(f"Could not obtain access token: {error_message}")
-        raise Exception(f"Could not obtain access token: {error_message}")
+    return TokenProvider(token_cache_file, tenant_id, client_id, client_secret, scopes).get()
+
+# Only the user attributes the sync reads are requested from Graph
+USER_SELECT = 'userPrincipalName,givenName,surname,mail,displayName,accountEnabled,id'
+USER_PAGE_SIZE = 999
+
+# Get users from Azure AD one page at a time
+@src.metrics.timed('graph_users')
+def iter_aad_users(client):
+    count = 0
+    params = {'$top': USER_PAGE_SIZE, '$select': USER_SELECT}
+    for page in client.iter_pages('/users', params=params):
+        count += len(page)
+        yield page
+    src.logger.logger.info(f"Retrieved {count} users from Azure AD")
 
 # Get users from Azure AD
-def get_aad_users(access_token):
-    headers = {'Authorization': f'Bearer {access_token}'}
-    users = []
-    url = 'https://graph.microsoft.com/v1.0/users'
+def get_aad_users(client):
+    return [user for page in iter_aad_users(client) for user in page]
+
+# Azure AD answers an expired or unknown delta token with one of these
+DELTA_RESYNC_STATUS = (400, 410)
+
+# Load the deltaLink saved by the previous delta sync, if any
+def load_delta_link(delta_link_file):
+    if not os.path.exists(delta_link_file):
+        return None
+    with open(delta_link_file, 'r') as f:
+        delta_link = f.read().strip()
+    return delta_link or None
+
+# Save the deltaLink so the next cycle only fetches what changed since this one
+def save_delta_link(delta_link_file, delta_link):
+    tmp_file = f"{delta_link_file}.tmp"
+    with open(tmp_file, 'w') as f:
+        f.write(delta_link)
+    os.replace(tmp_file, delta_link_file)
+
+# Get changed users from Azure AD using the delta query, one page at a time.
+# Without a delta_link a full baseline is fetched; if the stored link has
+# expired we fall back to one. Removed user ids and the new deltaLink are
+# left in result once the generator is exhausted.
+@src.metrics.timed('graph_users')
+def iter_aad_users_delta(client, delta_link=None, result=None):
+    result = result if result is not None else {}
+    result.update({'removed': [], 'deltaLink': None, 'baseline': delta_link is None})
+    base_url = f'/users/delta?$select={USER_SELECT}'
+    headers = {'Prefer': f'odata.maxpagesize={USER_PAGE_SIZE}'}
+    changed = 0
+    url = delta_link or base_url
     while url:
-        response = requests.get(url, headers=headers)
-        if response.status_code != 200:
-            src.logger.logger.error(f"Failed to retrieve users: {response.status_code} - {response.text}")
-            break
+        response = client.get(url, headers=headers)
+        if response.status_code in DELTA_RESYNC_STATUS and delta_link:
+            src.logger.logger.warning(f"Delta link rejected ({response.status_code}), falling back to a full resync")
+            result.update({'removed': [], 'baseline': True})
+            delta_link = None
+            url = base_url
+            continue
+        src.graph.check_response(response, "Retrieving user changes")
         data = response.json()
-        users.extend(data.get('value', []))
+        page = []
+        for user in data.get('value', []):
+            if '@removed' in user:
+                result['removed'].append(user['id'])
+            else:
+                page.append(user)
+        changed += len(page)
+        yield page
         url = data.get('@odata.nextLink')
-    src.logger.logger.info(f"Retrieved {len(users)} users from Azure AD")
-    return users
+        result['deltaLink'] = data.get('@odata.deltaLink', result['deltaLink'])
+
+    if result['baseline']:
+        src.logger.logger.info(f"Retrieved {changed} users from Azure AD (delta baseline)")
+    else:
+        src.logger.logger.info(f"Retrieved {changed} changed and {len(result['removed'])} removed users from Azure AD")
+
+# Get changed users from Azure AD using the delta query.
+# Returns (users, removed_ids, new_delta_link).
+def get_aad_users_delta(client, delta_link=None):
+    result = {}
+    users = [user for page in iter_aad_users_delta(client, delta_link, result) for user in page]
+    return users, result['removed'], result['deltaLink']
+
+# Get specific users from Azure AD through $batch, e.g. the ones named in
+# change notifications. Returns (users, removed_ids) where removed_ids are
+# the ids Graph no longer knows.
+def get_aad_users_by_ids(client, object_ids):
+    lookups = {object_id: f'/users/{object_id}?$select={USER_SELECT}' for object_id in object_ids}
+    users = []
+    removed = []
+    for object_id, item in client.batch(lookups).items():
+        if item.get('status') == 404:
+            removed.append(object_id)
+            continue
+        src.graph.check_batch_response(item, f"Retrieving user {object_id}")
+        users.append(item.get('body') or {})
+    return users, removed
 
 # Get groups from Azure AD
-def get_aad_groups(access_token):
-    headers = {'Authorization': f'Bearer {access_token}'}
-    groups = []
-    url = 'https://graph.microsoft.com/v1.0/groups'
-    while url:
-        response = requests.get(url, headers=headers)
-        if response.status_code != 200:
-            src.logger.logger.error(f"Failed to retrieve groups: {response.status_code} - {response.text}")
-            break
-        data = response.json()
-        groups.extend(data.get('value', []))
-        url = data.get('@odata.nextLink')
+def get_aad_groups(client):
+    groups = client.get_all('/groups')
     src.logger.logger.info(f"Retrieved {len(groups)} groups from Azure AD")
     return groups
 
 # Get group members from Azure AD
-def get_aad_group_members(access_token, group_id):
-    headers = {'Authorization': f'Bearer {access_token}'}
-    members = []
-    url = f'https://graph.microsoft.com/v1.0/groups/{group_id}/members'
-    while url:
-        response = requests.get(url, headers=headers)
-        if response.status_code != 200:
-            src.logger.logger.error(f"Failed to retrieve group members: {response.status_code} - {response.text}")
-            break
-        data = response.json()
-        members.extend(data.get('value', []))
-        url = data.get('@odata.nextLink')
-    return members
+def get_aad_group_members(client, group_id):
+    return client.get_all(f'/groups/{group_id}/members')
 
-def get_aad_group_member_by_name(access_token, group_name):
+# Quote a string literal for an OData $filter
+def escape_odata(value):
+    return value.replace("'", "''")
 
-    # Get group ID by name
-    headers = {'Authorization': f'Bearer {access_token}'}
-    url = f'https://graph.microsoft.com/v1.0/groups?$filter=displayName eq \'{group_name}\''
-    response = requests.get(url, headers=headers)
-    if response.status_code != 200:
-        src.logger.logger.error(f"Failed to retrieve group ID named [{group_name}]: {response.status_code} - {response.text}")
-        return None
-    data = response.json()
-    if 'value' in data and len(data['value']) > 0:
-        group_id = data['value'][0]['id']
-    else:
+# Look up a group by display name, None if there is no such group
+def get_aad_group_id_by_name(client, group_name):
+    group_filter = f"displayName eq '{escape_odata(group_name)}'"
+    data = client.get_json('/groups', params={'$filter': group_filter, '$select': 'id'})
+    if data.get('value'):
+        return data['value'][0]['id']
+    return None
+
+def get_aad_group_member_by_name(client, group_name):
+    group_id = get_aad_group_id_by_name(client, group_name)
+    if group_id is None:
         return None
+    return get_aad_group_members(client, group_id)
+
+# Get the members of many groups through $batch, following each group's
+# @odata.nextLink. path picks the relationship, e.g. transitiveMembers, and
+# headers go on every sub-request. Returns a dict mapping group id to its members.
+def get_aad_group_members_batch(client, group_ids, path='members', select=None, headers=None):
+    query = f"?$select={select}" if select else ''
+    members = {group_id: [] for group_id in group_ids}
+    pending = {group_id: f'/groups/{group_id}/{path}{query}' for group_id in group_ids}
+    while pending:
+        responses = client.batch(pending, headers=headers)
+        pending = {}
+        for group_id, item in responses.items():
+            src.graph.check_batch_response(item, f"Retrieving {path} of group {group_id}")
+            body = item.get('body') or {}
+            members[group_id].extend(body.get('value', []))
+            if body.get('@odata.nextLink'):
+                pending[group_id] = body['@odata.nextLink']
+    return members
+
+# Look up many groups by display name through $batch. Returns a dict mapping
+# each name to its group id, or None if there is no such group.
+def get_aad_group_ids_by_names(client, group_names):
+    lookups = {}
+    for group_name in group_names:
+        group_filter = quote(f"displayName eq '{escape_odata(group_name)}'")
+        lookups[group_name] = f"/groups?$filter={group_filter}&$select=id"
+    group_ids = {}
+    for group_name, item in client.batch(lookups).items():
+        src.graph.check_batch_response(item, f"Looking up group [{group_name}]")
+        value = (item.get('body') or {}).get('value', [])
+        group_ids[group_name] = value[0]['id'] if value else None
+    return group_ids
+
+# Get the members of many groups by display name with two batched passes.
+# Returns a dict mapping group id to members; unknown names are skipped.
+def get_aad_group_members_by_names(client, group_names):
+    group_ids = get_aad_group_ids_by_names(client, group_names)
+    for group_name, group_id in group_ids.items():
+        if group_id is None:
+            src.logger.logger.warning(f"Group [{group_name}] not found in Azure AD")
+    return get_aad_group_members_batch(client, [gid for gid in group_ids.values() if gid])
+
+# Resolve the members of every group with a bounded pool of workers, each
+# fetching one $batch worth of groups over the client's shared token and
+# connection pool. Returns a dict mapping group id to its members.
+def crawl_group_members(client, groups, concurrency=src.graph.DEFAULT_CONCURRENCY,
+                        path='members', select=None, headers=None):
+    group_ids = [group['id'] for group in groups]
+    chunks = [group_ids[i:i + src.graph.BATCH_SIZE] for i in range(0, len(group_ids), src.graph.BATCH_SIZE)]
+
+    def fetch(chunk, context):
+        started = time.monotonic()
+        members = context.run(get_aad_group_members_batch, client, chunk, path, select, headers)
+        return members, time.monotonic() - started
+
+    started = time.monotonic()
+    members = {}
+    sequential = 0.0
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        # each worker runs in a copy of the caller's context (metrics target, log cycle id)
+        contexts = [contextvars.copy_context() for _ in chunks]
+        for chunk_members, elapsed in executor.map(fetch, chunks, contexts):
+            members.update(chunk_members)
+            sequential += elapsed
+    wall = time.monotonic() - started
+
+    src.logger.logger.info(
+        f"Retrieved {path} of {len(members)} groups in {wall:.1f}s with {concurrency} workers "
+        f"(sequential {sequential:.1f}s)")
+    return members
 
-    members = []
-    url = f'https://graph.microsoft.com/v1.0/groups/{group_id}/members'
+# Get the ids of the groups whose properties or members changed since
+# delta_link, using the groups delta query. Without a delta_link (or once it
+# has expired) only a new link is fetched and None is returned for the
+# changes, meaning any group may have changed. Returns (changed_ids, delta_link).
+def get_aad_group_changes(client, delta_link=None):
+    base_url = '/groups/delta?$select=id,members&$deltatoken=latest'
+    changed = set() if delta_link else None
+    url = delta_link or base_url
     while url:
-        response = requests.get(url, headers=headers)
-        if response.status_code != 200:
-            src.logger.logger.error(f"Failed to retrieve group members: {response.status_code} - {response.text}")
-            break
+        response = client.get(url)
+        if response.status_code in DELTA_RESYNC_STATUS and changed is not None:
+            src.logger.logger.warning(f"Group delta link rejected ({response.status_code}), starting over")
+            changed = None
+            url = base_url
+            continue
+        src.graph.check_response(response, "Retrieving group changes")
         data = response.json()
-        members.extend(data.get('value', []))
+        if changed is not None:
+            changed.update(group['id'] for group in data.get('value', []))
         url = data.get('@odata.nextLink')
-    return members
\ No newline at end of file
+        delta_link = data.get('@odata.deltaLink', delta_link)
+    return changed, delta_link
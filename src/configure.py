@@ -5,19 +5,94 @@ import os
 import json
 import configparser
 
+import src.logger
+
 class ConfigError(Exception):
     """Custom exception for configuration errors."""
     pass
 
+# One configuration key: how to parse it, its default and allowed values
+class Option:
+
+    def __init__(self, type=str, default=None, required=False, choices=None):
+        self.type = type
+        self.default = default
+        self.required = required
+        self.choices = choices
+
+    def parse(self, value):
+        if self.type is list:
+            return [item.strip() for item in value.split(',') if item.strip()]
+        value = self.type(value)
+        if self.choices and value not in self.choices:
+            raise ValueError(f"expected one of {', '.join(self.choices)}")
+        return value
+
 class Config:
-    MANDATORY_SECTIONS = ['azure_ad', 'freeipa', 'sync', 'mail', 'logging']
-    MANDATORY_KEYS = {
-        'azure_ad': ['client_id', 'client_secret', 'tenant_id', 'scope', 'token_cache'],
-        'freeipa': ['server', 'user', 'password', 'basedn'],
-        'sync': ['interval'],
-        'mail': ['server', 'port', 'user', 'password'],
-        'logging': ['level']
+    SCHEMA = {
+        'azure_ad': {
+            'client_id': Option(required=True),
+            'client_secret': Option(required=True),
+            'tenant_id': Option(required=True),
+            'scope': Option(required=True),
+            'token_cache': Option(required=True),
+            'timeout': Option(int, 60),
+            'max_retries': Option(int, 5),
+            'concurrency': Option(int, 4),
+            'rate_limit': Option(float),
+        },
+        'freeipa': {
+            'server': Option(required=True),
+            'realm': Option(required=True),
+            'user': Option(required=True),
+            'password': Option(required=True),
+            'basedn': Option(required=True),
+            'id_allocator': Option(str, 'highwater', choices=('highwater', 'range')),
+            'id_range': Option(),
+            'id_block_size': Option(int, 100),
+        },
+        'newuser': {
+            'password': Option(required=True),
+        },
+        'sync': {
+            'interval': Option(int, required=True),
+            'mode': Option(str, 'full', choices=('full', 'delta')),
+            'groups': Option(list, []),
+            'jitter': Option(float, 0.1),
+            'max_backoff': Option(int, 3600),
+            'lock_dir': Option(),
+            'shards': Option(int, 1),
+            'deprovision': Option(str, 'none', choices=('none', 'disable', 'preserve')),
+            'max_parallel_targets': Option(int, 2),
+        },
+        'mail': {
+            'server': Option(required=True),
+            'port': Option(int, required=True),
+            'user': Option(required=True),
+            'password': Option(required=True),
+            'recipients': Option(list, []),
+            'digest_window': Option(int, 0),
+            'timeout': Option(int, 30),
+            'spool_dir': Option(),
+        },
+        'logging': {
+            'level': Option(str.upper, required=True, choices=('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')),
+            'format': Option(str, 'text', choices=('text', 'json')),
+        },
+        'metrics': {
+            'port': Option(int),
+            'textfile': Option(),
+        },
+        'listener': {
+            'notification_url': Option(),
+            'port': Option(int, 8765),
+            'client_state': Option(),
+        },
     }
+    MANDATORY_SECTIONS = ['azure_ad', 'freeipa', 'newuser', 'sync', 'mail', 'logging']
+    # sections each named target has its own copy of: [azure_ad:name] and
+    # [freeipa:name]; any other section can be overridden per target too
+    TARGET_SECTIONS = ['azure_ad', 'freeipa']
 
     def __init__(self, config_file_path):
         self.config_file_path = config_file_path
@@ -38,17 +113,116 @@ class Config:
             for key, value in self.config.items(section):
                 self.config_dict[section][key] = value.strip('\'"')  # Remove quotes if present
 
+    # Check mandatory keys and parse every known key into its type, once
     def validate_config(self):
+        targets = self.target_names()
         for section in self.MANDATORY_SECTIONS:
+            if section in self.TARGET_SECTIONS and targets:
+                continue
             if section not in self.config_dict:
                 raise ConfigError(f"Mandatory section '{section}' is missing in the configuration file.")
-            for key in self.MANDATORY_KEYS[section]:
-                if key not in self.config_dict[section]:
+        for name in targets:
+            for section in self.TARGET_SECTIONS:
+                if f"{section}:{name}" not in self.config_dict:
+                    raise ConfigError(f"Section '{section}:{name}' is missing for target '{name}'.")
+
+        for section, options in self.SCHEMA.items():
+            # without a bare [azure_ad]/[freeipa] only their defaults are kept
+            required = not (section in self.TARGET_SECTIONS and targets)
+            self.parse_section(section, options, required=required, defaults=True)
+        for section in self.config_dict:
+            base, _, name = section.partition(':')
+            if name and base in self.SCHEMA:
+                self.parse_section(section, self.SCHEMA[base], required=base in self.TARGET_SECTIONS, defaults=False)
+
+    # Parse the values of a section; the defaults are only filled in for the
+    # shared sections, so a per-target section only overrides what it sets
+    def parse_section(self, section, options, required, defaults):
+        values = self.config_dict.setdefault(section, {})
+        for key, option in options.items():
+            if key not in values or values[key] == '':
+                if option.required and required:
                     raise ConfigError(f"Mandatory key '{key}' is missing in section '{section}'.")
+                if defaults:
+                    values[key] = option.default
+                else:
+                    values.pop(key, None)
+                continue
+            try:
+                values[key] = option.parse(values[key])
+            except ValueError as e:
+                raise ConfigError(f"Invalid value '{values[key]}' for '{key}' in section '{section}': {e}")
+
+    # Names of the targets configured with [azure_ad:name] sections
+    def target_names(self):
+        return sorted(section.split(':', 1)[1] for section in self.config_dict
+                      if section.startswith('azure_ad:') and section.split(':', 1)[1])
 
     def get(self, section, key):
         return self.config_dict.get(section, {}).get(key)
 
+    # Sections whose values differ from another config
+    def changed_sections(self, other):
+        sections = set(self.config_dict) | set(other.config_dict)
+        return sorted(section for section in sections
+                      if self.config_dict.get(section) != other.config_dict.get(section))
+
+# View of the configuration for one named target: a key set in the target's
+# own [section:name] wins over the shared [section]
+class TargetConfig:
+
+    def __init__(self, config, name=None):
+        self.config = config
+        self.name = name
+
+    @property
+    def config_file_path(self):
+        return self.config.config_file_path
+
+    def get(self, section, key):
+        if self.name:
+            values = self.config.config_dict.get(f"{section}:{self.name}")
+            if values and key in values:
+                return values[key]
+        return self.config.get(section, key)
+
+# Reload the configuration file when asked to (SIGHUP) or when it changed on
+# disk. A file that fails to load or validate is reported and the previous
+# configuration stays in use.
+class ConfigReloader:
+
+    def __init__(self, config):
+        self.config = config
+        self.mtime = self.file_mtime()
+        self.requested = False
+
+    def file_mtime(self):
+        try:
+            return os.stat(self.config.config_file_path).st_mtime
+        except OSError:
+            return None
+
+    # signal handler
+    def request(self, signum=None, frame=None):
+        self.requested = True
+
+    # Return a new Config if the file was reloaded, None otherwise
+    def check(self):
+        mtime = self.file_mtime()
+        if not self.requested and mtime == self.mtime:
+            return None
+        self.requested = False
+        self.mtime = mtime
+        try:
+            config = Config(self.config.config_file_path)
+        except (FileNotFoundError, ConfigError, configparser.Error) as e:
+            src.logger.logger.error(f"Keeping the running configuration, reload failed: {e}")
+            return None
+        changed = config.changed_sections(self.config)
+        self.config = config
+        src.logger.logger.info(f"Configuration reloaded, changed sections: {', '.join(changed) or 'none'}")
+        return config
+
 # Example usage
 if __name__ == "__main__":
     config_file_path = '/Users/jtong/python/aad_sync/cfg/aad_sync.conf'
@@ -56,4 +230,4 @@ if __name__ == "__main__":
         config = Config(config_file_path)
         print(json.dumps(config.config_dict, indent=4))
     except (FileNotFoundError, ConfigError) as e:
-        print(f"Configuration error: {e}")
\ No newline at end of file
+        print(f"Configuration error: {e}")
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# Azure AD user/group FreeIPA sync utility
+# Copyright (c) 2024 Jackson Tong, Creekside Networks LLC.
+#
+# Deprovisioning of offboarded Azure AD accounts. Users disabled in Azure AD
+# get their FreeIPA account locked (nsAccountLock); users deleted from Azure
+# AD are locked, or with [sync] deprovision = preserve also moved to the
+# preserved users container like `ipa user-del --preserve`. Accounts come
+# back when the Azure AD user is enabled or restored again. All changes are
+# pipelined on the sync's FreeIPA connection and the state store says which
+# entry each object id maps to, so no per-user search is needed. An entry
+# maps to one object id only (see StateStore.claim_user), so offboarding a
+# user never locks or moves another user's account.
+
+import src.logger
+import src.freeIPA
+import src.metrics
+import src.state
+
+def preserved_container(basedn):
+    return f'cn=deleted users,cn=accounts,cn=provisioning,{basedn}'
+
+def deprovision_mode(config):
+    return config.get('sync', 'deprovision')
+
+# Lock the given users; with preserve also move those in removed_ids to the
+# preserved users container. Returns the number of users that failed
+# transiently; the others are retried when they come up again.
+@src.metrics.timed('deprovision')
+def deprovision_users(config, ipa, state, disabled_ids, removed_ids, mode):
+    if mode == 'none':
+        return 0
+    records = {}
+    for object_id in set(disabled_ids) | set(removed_ids):
+        record = state.get_user(object_id)
+        if record and record['status'] != src.state.PRESERVED:
+            records[object_id] = record
+
+    locks = {object_id: record['dn'] for object_id, record in records.items()
+             if record['status'] == src.state.ACTIVE}
+    failed = {}
+    locked = src.freeIPA.set_users_locked(ipa, locks, True, failed)
+    for object_id in locked:
+        state.set_user_status(object_id, src.state.DISABLED)
+        records[object_id]['status'] = src.state.DISABLED
+    src.metrics.USERS_DEPROVISIONED.inc(len(locked), action='disable')
+
+    if mode == 'preserve':
+        moves = {object_id: records[object_id]['dn'] for object_id in removed_ids
+                 if object_id in records and records[object_id]['status'] == src.state.DISABLED}
+        moved = src.freeIPA.move_users(ipa, moves, preserved_container(config.get('freeipa', 'basedn')), failed)
+        for object_id, dn in moved.items():
+            state.set_user_status(object_id, src.state.PRESERVED, dn)
+        src.metrics.USERS_DEPROVISIONED.inc(len(moved), action='preserve')
+
+    state.commit()
+    return src.freeIPA.transient_count(failed)
+
+# Bring back the accounts of users enabled or restored in Azure AD: move
+# preserved ones back under base_dn, then unlock. Returns the transient
+# failures.
+@src.metrics.timed('deprovision')
+def reactivate_users(ipa, state, base_dn, object_ids):
+    records = {}
+    for object_id in object_ids:
+        record = state.get_user(object_id)
+        if record and record['status'] != src.state.ACTIVE:
+            records[object_id] = record
+    if not records:
+        return 0
+
+    moves = {object_id: record['dn'] for object_id, record in records.items()
+             if record['status'] == src.state.PRESERVED}
+    failed = {}
+    moved = src.freeIPA.move_users(ipa, moves, base_dn, failed)
+    for object_id, dn in moved.items():
+        state.set_user_status(object_id, src.state.DISABLED, dn)
+        records[object_id]['dn'] = dn
+    unlocks = {object_id: record['dn'] for object_id, record in records.items()
+               if object_id not in moves or object_id in moved}
+    unlocked = src.freeIPA.set_users_locked(ipa, unlocks, False, failed)
+    for object_id in unlocked:
+        state.set_user_status(object_id, src.state.ACTIVE)
+
+    state.commit()
+    return src.freeIPA.transient_count(failed)
@@ -3,47 +3,158 @@
 # Copyright (c) 2024 Jackson Tong, Creekside Networks LLC.
 
 import ldap3
+import ldap3.core.exceptions
+import ldap3.core.results
+import ldap3.utils.conv
 import ssl
+from collections import deque
 import src.logger
+import src.metrics
+
+# LDAP writes kept in flight at once on the pipelined connection
+PIPELINE_WINDOW = 50
+
+# LDAP results worth retrying soon: the server was busy, unavailable or timed
+# out, or the connection failed (-1, set by run_pipelined). Anything else,
+# e.g. a value FreeIPA rejects, fails the same way until the data changes.
+TRANSIENT_RESULTS = (-1, 3, 51, 52, 81, 85)
+
+# member values changed per modify when updating group membership
+MEMBER_CHUNK_SIZE = 500
+
+# rounds over the server pool before giving up with
+# LDAPServerPoolExhaustedError; active=True would retry forever
+SERVER_POOL_ROUNDS = 1
+
+# attributes of a user that are synced from Azure AD
+USER_SYNCED_ATTRIBUTES = ['cn', 'givenName', 'sn', 'mail']
+
+# uids looked up per search when indexing only some users
+UID_LOOKUP_CHUNK_SIZE = 100
+
+# entries per page of a paged search, below FreeIPA's default size limit
+SEARCH_PAGE_SIZE = 1000
+
+# Stream the entries of a search using the Simple Paged Results control, so
+# no single response hits the server's size limit and only one page is held
+# in memory. Yields (dn, raw_attributes) straight from the response, with the
+# values as bytes, instead of building ldap3 Entry objects. A search that
+# ends in anything but success raises LDAPOperationResult once the entries
+# are consumed, so partial results are never taken for the whole set.
+def stream_search(conn, base_dn, search_filter, attributes, search_scope=ldap3.SUBTREE,
+                  page_size=SEARCH_PAGE_SIZE):
+    responses = conn.extend.standard.paged_search(
+        search_base=base_dn,
+        search_filter=search_filter,
+        search_scope=search_scope,
+        attributes=attributes,
+        paged_size=page_size,
+        generator=True
+    )
+    for response in responses:
+        if response.get('type') == 'searchResEntry':
+            yield response['dn'], response['raw_attributes']
+    src.metrics.count_ldap('search', conn.result)
+    if conn.result['result'] != ldap3.core.results.RESULT_SUCCESS:
+        raise ldap3.core.exceptions.LDAPOperationResult(
+            result=conn.result['result'], description=conn.result.get('description'), dn=base_dn,
+            message=f"Search of {base_dn} failed: {conn.result.get('message')}", response_type='searchResDone')
+
+# Values of a raw attribute as strings
+def raw_values(raw_attributes, name):
+    return [value.decode('utf-8') for value in raw_attributes.get(name) or []]
+
+# First value of a raw attribute as a string, or None
+def raw_value(raw_attributes, name):
+    values = raw_attributes.get(name)
+    return values[0].decode('utf-8') if values else None
 
 # check if an user exists in FreeIPA
+@src.metrics.timed('user_lookup')
 def check_user_exists(conn, base_dn, uid):
-    search_filter = f"(uid={uid})"
-    conn.search(search_base=base_dn, search_filter=search_filter, search_scope=ldap3.SUBTREE, attributes=['uid'])
-    return len(conn.entries) > 0
+    search_filter = f"(uid={ldap3.utils.conv.escape_filter_chars(uid)})"
+    return len(list(stream_search(conn, base_dn, search_filter, ['uid']))) > 0
+
+
+# In-memory index of the users already in FreeIPA, so existence checks in a
+# sync cycle don't cost one LDAP search per Azure AD user
+class UserIndex:
+    def __init__(self):
+        self.by_uid = {}
+        self.by_mail = {}
+
+    def add(self, uid, uid_number=None, mail=None, attrs=None):
+        uid = uid.lower()
+        self.by_uid[uid] = {'uid': uid, 'uidNumber': uid_number, 'mail': mail, 'attrs': attrs}
+        if mail:
+            self.by_mail[mail.lower()] = uid
+
+    def has_uid(self, uid):
+        return uid.lower() in self.by_uid
+
+    def get_by_uid(self, uid):
+        return self.by_uid.get(uid.lower())
+
+    def get_by_mail(self, mail):
+        uid = self.by_mail.get(mail.lower()) if mail else None
+        return self.by_uid.get(uid) if uid else None
 
+    def __len__(self):
+        return len(self.by_uid)
+
+# Add the entries of a user search to index
+def index_entries(index, entries):
+    for dn, raw in entries:
+        uid_number = raw_value(raw, 'uidNumber')
+        mail = raw_value(raw, 'mail')
+        attrs = {name: raw_value(raw, name) or '' for name in USER_SYNCED_ATTRIBUTES}
+        for uid in raw_values(raw, 'uid'):
+            index.add(uid, int(uid_number) if uid_number is not None else None, mail, attrs)
+
+# Build the user index with a single paged search of the users container,
+# keeping the synced attributes each entry has now
+@src.metrics.timed('user_index')
+def load_user_index(conn, base_dn, page_size=SEARCH_PAGE_SIZE):
+    index = UserIndex()
+    entries = stream_search(conn, base_dn, '(uid=*)', ['uid', 'uidNumber'] + USER_SYNCED_ATTRIBUTES,
+                            page_size=page_size)
+    index_entries(index, entries)
+    src.logger.logger.info(f"Loaded {len(index)} FreeIPA users into the index")
+    return index
+
+# Build a user index of just the given uids, e.g. for the few users of a
+# change notification, instead of reading the whole users container
+@src.metrics.timed('user_index')
+def load_user_index_for(conn, base_dn, uids, chunk_size=UID_LOOKUP_CHUNK_SIZE):
+    index = UserIndex()
+    uids = sorted(set(uids))
+    for start in range(0, len(uids), chunk_size):
+        terms = ''.join(f"(uid={ldap3.utils.conv.escape_filter_chars(uid)})" for uid in uids[start:start + chunk_size])
+        index_entries(index, stream_search(conn, base_dn, f"(|{terms})", ['uid', 'uidNumber'] + USER_SYNCED_ATTRIBUTES))
+    return index
 
 # Get the next available UID/GID number
+@src.metrics.timed('uid_scan')
 def get_next_uid_number(conn, base_dn):
     #print("Getting next UID/GID number")
-    conn.search(
-        search_base=base_dn,
-        search_filter='(objectClass=posixAccount)',
-        search_scope=ldap3.SUBTREE,
-        #attributes=['uidNumber']
-        attributes=['uidNumber', 'gidNumber']
-    )
-    id_numbers = []
-    for entry in conn.entries:
-        if 'uidNumber' in entry.entry_attributes_as_dict:
-            id_numbers.append(int(entry.entry_attributes_as_dict['uidNumber'][0]))
-        if 'gidNumber' in entry.entry_attributes_as_dict:
-            id_numbers.append(int(entry.entry_attributes_as_dict['gidNumber'][0]))
-
-    if id_numbers:
-        next_id = max(id_numbers) + 1
+    highest = None
+    for dn, raw in stream_search(conn, base_dn, '(objectClass=posixAccount)', ['uidNumber', 'gidNumber']):
+        for attr in ('uidNumber', 'gidNumber'):
+            value = raw_value(raw, attr)
+            if value is not None and (highest is None or int(value) > highest):
+                highest = int(value)
+
+    if highest is not None:
+        next_id = highest + 1
     else:
         next_id = 10000
 
     #print(f"Next UID/GID number: {next_id}")
     return next_id
 
-# add an user to FreeIPA
-def create_user(conn, base_dn, user_data):
-    uid = user_data['uid']
-    user_dn = f"uid={uid},{base_dn}"
-
-    attributes = {
+# LDAP attributes of a new FreeIPA user
+def user_attributes(user_data):
+    return {
         "objectClass": [
             "top",
             "person",
@@ -66,80 +177,334 @@ def create_user(conn, base_dn, user_data):
         'gidNumber': user_data['gidNumber'],
         'uidNumber': user_data['uidNumber'],
         "krbPrincipalName": user_data['krbPrincipalName']
-    }  
+    }
+
+# add an user to FreeIPA, True if it was created
+@src.metrics.timed('create_user')
+def create_user(conn, base_dn, user_data):
+    uid = user_data['uid']
+    user_dn = f"uid={uid},{base_dn}"
 
     try:
-        conn.add(user_dn, attributes=attributes)
+        conn.add(user_dn, attributes=user_attributes(user_data))
+        src.metrics.count_ldap('add', conn.result)
         if conn.result['result'] == 0:
             src.logger.logger.info(f"User '{uid}' created successfully.")
+            return True
         else:
             src.logger.logger.error(f"Failed to create user '{uid}': {conn.result}")
+            return False
     except Exception as e:
         src.logger.logger.error(f"An error occurred while creating user '{uid}': {e}")
         raise
 
+# Send LDAP operations on an ASYNC connection keeping up to window of them in
+# flight. operations yields (key, method, args) such as
+# (uid, 'add', (dn, attributes)); returns a dict mapping key to LDAP result.
+def run_pipelined(conn, operations, window=PIPELINE_WINDOW):
+    results = {}
+    method_of = {}
+    in_flight = deque()
+
+    def collect():
+        key, message_id = in_flight.popleft()
+        try:
+            _, result = conn.get_response(message_id)
+        except ldap3.core.exceptions.LDAPException as e:
+            result = {'result': -1, 'description': str(e)}
+        src.metrics.count_ldap(method_of[key], result)
+        results[key] = result
+
+    for key, method, args in operations:
+        if len(in_flight) >= window:
+            collect()
+        method_of[key] = method
+        in_flight.append((key, getattr(conn, method)(*args)))
+    while in_flight:
+        collect()
+    return results
+
+# Whether a failed operation's result is worth retrying with the next cycle
+def is_transient(result):
+    return result.get('result', -1) in TRANSIENT_RESULTS
+
+# Number of transient results among the failures collected by the bulk
+# operations below
+def transient_count(failed):
+    return sum(1 for result in failed.values() if is_transient(result))
+
+# add many users to FreeIPA with the adds pipelined on one connection.
+# Returns only the user_data entries whose add really succeeded; the results
+# of the others go into failed (keyed by uid) if given.
+@src.metrics.timed('create_users')
+def create_users(ipa, base_dn, users_data, failed=None):
+    if not users_data:
+        return []
+    operations = (
+        (user_data['uid'], 'add', (f"uid={user_data['uid']},{base_dn}", None, user_attributes(user_data)))
+        for user_data in users_data
+    )
+    results = ipa.pipeline(operations)
+
+    created = []
+    for user_data in users_data:
+        result = results.get(user_data['uid'], {})
+        if result.get('result') == 0:
+            src.logger.logger.info("User '%s' created successfully.", user_data['uid'])
+            created.append(user_data)
+        else:
+            src.logger.logger.error("Failed to create user '%s': %s", user_data['uid'], result)
+            if failed is not None:
+                failed[user_data['uid']] = result
+    return created
+
+# update attributes of many users with pipelined MODIFY_REPLACE operations.
+# updates maps a caller chosen key to (dn, {attribute: value}); empty values
+# clear the attribute, except for cn and sn which FreeIPA requires.
+# Returns the keys whose modify succeeded; the results of the others go into
+# failed if given.
+@src.metrics.timed('update_users')
+def update_users(ipa, updates, failed=None):
+    if not updates:
+        return []
+    operations = []
+    for key, (dn, attributes) in updates.items():
+        changes = {}
+        for name, value in attributes.items():
+            if value:
+                changes[name] = [(ldap3.MODIFY_REPLACE, [value])]
+            elif name not in ('cn', 'sn'):
+                changes[name] = [(ldap3.MODIFY_REPLACE, [])]
+        operations.append((key, 'modify', (dn, changes)))
+    results = ipa.pipeline(operations)
+
+    updated = []
+    for key, (dn, attributes) in updates.items():
+        result = results.get(key, {})
+        if result.get('result') == 0:
+            src.logger.logger.info("User '%s' updated: %s", dn, ', '.join(sorted(attributes)))
+            updated.append(key)
+        else:
+            src.logger.logger.error("Failed to update user '%s': %s", dn, result)
+            if failed is not None:
+                failed[key] = result
+    return updated
+
+# set or clear nsAccountLock on many users with pipelined modifies.
+# dns maps a key to the user's DN; returns the keys that succeeded, the
+# results of the others go into failed if given.
+def set_users_locked(ipa, dns, locked=True, failed=None):
+    if not dns:
+        return []
+    value = 'TRUE' if locked else 'FALSE'
+    operations = [
+        (key, 'modify', (dn, {'nsAccountLock': [(ldap3.MODIFY_REPLACE, [value])]}))
+        for key, dn in dns.items()
+    ]
+    results = ipa.pipeline(operations)
+
+    done = []
+    for key, dn in dns.items():
+        result = results.get(key, {})
+        if result.get('result') == 0:
+            src.logger.logger.info("User '%s' %s.", dn, 'locked' if locked else 'unlocked')
+            done.append(key)
+        else:
+            src.logger.logger.error("Failed to %s user '%s': %s", 'lock' if locked else 'unlock', dn, result)
+            if failed is not None:
+                failed[key] = result
+    return done
+
+# move many user entries under new_superior with pipelined modify DN
+# operations. Returns {key: new DN} for the moves that succeeded; the results
+# of the others go into failed if given.
+def move_users(ipa, dns, new_superior, failed=None):
+    if not dns:
+        return {}
+    operations = [
+        (key, 'modify_dn', (dn, dn.split(',', 1)[0], True, new_superior))
+        for key, dn in dns.items()
+    ]
+    results = ipa.pipeline(operations)
+
+    moved = {}
+    for key, dn in dns.items():
+        result = results.get(key, {})
+        if result.get('result') == 0:
+            moved[key] = f"{dn.split(',', 1)[0]},{new_superior}"
+            src.logger.logger.info("User '%s' moved to '%s'.", dn, new_superior)
+        else:
+            src.logger.logger.error("Failed to move user '%s': %s", dn, result)
+            if failed is not None:
+                failed[key] = result
+    return moved
+
 def sync_users(conn, base_dn, users):
     for user in users:
         uid = user['uid']
         if not check_user_exists(conn, base_dn, uid):
             create_user(conn, base_dn, uid, user)
 
-def freeIPA_bind(server_address, username, password):
+# Bind to FreeIPA. server_address may list several servers separated by
+# commas; they are tried in order through an ldap3 ServerPool.
+@src.metrics.timed('ldap_bind')
+def freeIPA_bind(server_address, username, password, client_strategy=ldap3.SYNC):
     try:
         # Configure TLS
         tls_configuration = ldap3.Tls(validate=ssl.CERT_NONE)
 
         # Bind to FreeIPA server using StartTLS (port 389)
         #print(f"Binding to FreeIPA server {server_address} as user {username}")
-        server = ldap3.Server(server_address, port=389, get_info=ldap3.ALL, use_ssl=False, tls=tls_configuration)
-        conn = ldap3.Connection(server, user=username, password=password)
+        servers = [
+            ldap3.Server(address.strip(), port=389, get_info=ldap3.ALL, use_ssl=False, tls=tls_configuration)
+            for address in server_address.split(',') if address.strip()
+        ]
+        server_pool = ldap3.ServerPool(servers, ldap3.FIRST, active=SERVER_POOL_ROUNDS, exhaust=60)
+        conn = ldap3.Connection(server_pool, user=username, password=password, client_strategy=client_strategy)
+        conn.open()
         if not conn.start_tls():
             src.logger.logger.error(f"Failed to start TLS: {conn.result}")
             raise Exception(f"Failed to start TLS: {conn.result}")
-        if not conn.bind():
+        bound = conn.bind()
+        src.metrics.count_ldap('bind', conn.result)
+        if not bound:
             src.logger.logger.error(f"Failed to bind to FreeIPA server: {conn.result}")
             raise Exception(f"Failed to bind to FreeIPA server: {conn.result}")
-        src.logger.logger.info("Successfully bound to FreeIPA server")
+        src.logger.logger.info(f"Successfully bound to FreeIPA server {conn.server.host}")
         return conn
     except Exception as e:
         src.logger.logger.error(f"An error occurred while binding to FreeIPA server: {e}")
         raise
 
+# FreeIPA connection that lives across sync cycles: bound once, checked with
+# a cheap rootDSE read before each cycle and transparently re-established
+# (failing over to the next server) when the check fails
+class FreeIPAConnection:
+
+    def __init__(self, server_address, username, password):
+        self.server_address = server_address
+        self.username = username
+        self.password = password
+        self.conn = None
+        self.async_conn = None
+
+    def bind(self, client_strategy=ldap3.SYNC):
+        return freeIPA_bind(self.server_address, self.username, self.password, client_strategy=client_strategy)
+
+    def connect(self):
+        self.close()
+        self.conn = self.bind()
+        return self.conn
+
+    def is_alive(self):
+        return connection_alive(self.conn)
+
+    def async_alive(self):
+        return connection_alive(self.async_conn)
+
+    # Return a working connection, reconnecting if the current one (or the
+    # pipelining one, once bound) is dead
+    def ensure(self):
+        if not self.is_alive():
+            if self.conn is not None:
+                src.logger.logger.warning("FreeIPA connection lost, reconnecting")
+            self.connect()
+        if self.async_conn is not None and not self.async_alive():
+            src.logger.logger.warning("FreeIPA pipelining connection lost, reconnecting")
+            unbind_quietly(self.async_conn)
+            self.async_conn = None
+            self.async_conn = self.bind(ldap3.ASYNC)
+        return self.conn
+
+    # Run LDAP operations pipelined on a second, ASYNC connection that is
+    # bound on first use and kept for later cycles
+    def pipeline(self, operations, window=PIPELINE_WINDOW):
+        if self.async_conn is None or self.async_conn.closed:
+            self.async_conn = self.bind(ldap3.ASYNC)
+        try:
+            return run_pipelined(self.async_conn, operations, window)
+        except ldap3.core.exceptions.LDAPException:
+            unbind_quietly(self.async_conn)
+            self.async_conn = None
+            raise
+
+    def close(self):
+        unbind_quietly(self.conn)
+        unbind_quietly(self.async_conn)
+        self.conn = None
+        self.async_conn = None
+
+# Cheap rootDSE read telling whether a connection (SYNC or ASYNC) still works
+def connection_alive(conn):
+    if conn is None or conn.closed:
+        return False
+    try:
+        found = conn.search(search_base='', search_filter='(objectClass=*)',
+                            search_scope=ldap3.BASE, attributes=['namingContexts'])
+        if conn.strategy.sync:
+            return found
+        _, result = conn.get_response(found)
+        return result['result'] == ldap3.core.results.RESULT_SUCCESS
+    except ldap3.core.exceptions.LDAPException:
+        return False
+
+def unbind_quietly(conn):
+    if conn is None:
+        return
+    try:
+        conn.unbind()
+    except ldap3.core.exceptions.LDAPException:
+        pass
+
 def check_group_exists(conn, base_dn, group_name):
-    search_filter = f"(cn={group_name})"
-    conn.search(search_base=base_dn, search_filter=search_filter, search_scope=ldap3.SUBTREE, attributes=['cn'])
-    return len(conn.entries) > 0
+    search_filter = f"(cn={ldap3.utils.conv.escape_filter_chars(group_name)})"
+    return len(list(stream_search(conn, base_dn, search_filter, ['cn']))) > 0
 
 def get_group_members(conn, base_dn, group_name):
     #group_dn = f"cn={group_name},{base_dn}"
-    search_filter = f"(cn={group_name})"
-    conn.search(search_base=base_dn, search_filter=search_filter, search_scope=ldap3.SUBTREE, attributes=['member'])
-    if len(conn.entries) > 0:
-        members = conn.entries[0]['member']
-        return members
-    else:
-        src.logger.logger.error(f"Group '{group_name}' not found.")
-        return []
+    search_filter = f"(cn={ldap3.utils.conv.escape_filter_chars(group_name)})"
+    entries = list(stream_search(conn, base_dn, search_filter, ['member']))
+    if entries:
+        return raw_values(entries[0][1], 'member')
+    src.logger.logger.error(f"Group '{group_name}' not found.")
+    return []
 
 
 def create_group(conn, base_dn, group_name, description):
     group_dn = f"cn={group_name},{base_dn}"
     attributes = {
-        'objectClass': ['top', 'groupOfNames'],
+        'objectClass': ['top', 'groupOfNames', 'nestedGroup', 'ipaUserGroup', 'ipaObject'],
         'cn': group_name,
         'description': description,
-        'member': []  # Initialize with an empty member list
+        'ipaUniqueID': 'autogenerate'
     }
     try:
         conn.add(group_dn, attributes=attributes)
+        src.metrics.count_ldap('add', conn.result)
         if conn.result['result'] == 0:
             src.logger.logger.info(f"Group '{group_name}' created successfully.")
+            return True
         else:
             src.logger.logger.error(f"Failed to create group '{group_name}': {conn.result}")
+            return False
     except Exception as e:
         src.logger.logger.error(f"An error occurred while creating group '{group_name}': {e}")
         raise
 
+# Add and remove group members in chunks, so a large group is changed with a
+# few small modifies instead of rewriting its whole member list
+def modify_group_members(conn, group_dn, add=(), remove=(), chunk_size=MEMBER_CHUNK_SIZE):
+    ok = True
+    for operation, member_dns in ((ldap3.MODIFY_DELETE, sorted(remove)), (ldap3.MODIFY_ADD, sorted(add))):
+        for i in range(0, len(member_dns), chunk_size):
+            chunk = member_dns[i:i + chunk_size]
+            conn.modify(group_dn, {'member': [(operation, chunk)]})
+            src.metrics.count_ldap('modify', conn.result)
+            if conn.result['result'] != 0:
+                src.logger.logger.error(f"Failed to update members of '{group_dn}': {conn.result}")
+                ok = False
+    return ok
+
 # Example usage
 if __name__ == "__main__":
     server_address = 'ipa1.icm.corp'
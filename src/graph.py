@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+# Azure AD user/group FreeIPA sync utility
+# Copyright (c) 2024 Jackson Tong, Creekside Networks LLC.
+
+import time
+import random
+import threading
+import contextvars
+from queue import Queue, Full
+import requests
+from requests.adapters import HTTPAdapter
+
+import src.logger
+import src.metrics
+
+GRAPH_URL = 'https://graph.microsoft.com/v1.0'
+
+# responses worth retrying: throttling and transient gateway errors
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+DEFAULT_TIMEOUT = 60
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_POOL_SIZE = 10
+
+# Graph accepts at most 20 sub-requests per JSON $batch POST
+BATCH_SIZE = 20
+
+DEFAULT_CONCURRENCY = 4
+
+class GraphError(Exception):
+    """Raised when a Microsoft Graph request fails."""
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+class GraphThrottledError(GraphError):
+    """Raised when Graph keeps throttling a request after every retry."""
+    pass
+
+# Token bucket shared by every thread using a client, so parallel fetches
+# stay under a global request rate and don't trip Graph throttling
+class RateLimiter:
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.capacity = float(burst or rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, count=1):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= count or self.tokens >= self.capacity:
+                    self.tokens -= count
+                    return
+                wait = (min(count, self.capacity) - self.tokens) / self.rate
+            time.sleep(wait)
+
+# HTTP session with a keep-alive connection pool of pool_size connections
+def new_session(pool_size=DEFAULT_POOL_SIZE):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers.update({
+        'Accept': 'application/json',
+        'Accept-Encoding': 'gzip',
+    })
+    return session
+
+# Shared Microsoft Graph HTTP client: one keep-alive connection pool for every
+# request, bounded retries with exponential backoff and jitter that honour
+# Retry-After, and a timeout on every request. access_token is either a token
+# string or a provider with get() and invalidate() (src.aad.TokenProvider);
+# with a provider a 401 response is retried once with a fresh token.
+# Clients of several tenants can share one session, the token is sent with
+# each request.
+class GraphClient:
+
+    def __init__(self, access_token, base_url=GRAPH_URL, timeout=DEFAULT_TIMEOUT,
+                 max_retries=DEFAULT_MAX_RETRIES, backoff=1.0, max_backoff=60.0,
+                 pool_size=DEFAULT_POOL_SIZE, rate_limiter=None, session=None):
+        self.access_token = access_token
+        self.rate_limiter = rate_limiter
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.session = session or new_session(pool_size)
+
+    def url(self, path):
+        if path.startswith('http://') or path.startswith('https://'):
+            return path
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+    def retry_delay(self, response, attempt):
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                return float(retry_after) + random.uniform(0, 1)
+            except ValueError:
+                pass
+        # full jitter over the exponential backoff window
+        return random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt)))
+
+    # Send a request, retrying throttled and transient failures. Returns the
+    # final response whatever its status; callers decide what is an error.
+    def request(self, method, path, params=None, json=None, headers=None):
+        url = self.url(path)
+        request_headers = dict(headers or {})
+        token_retried = False
+
+        attempt = 0
+        while True:
+            request_headers['Authorization'] = f'Bearer {self.token()}'
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            try:
+                response = self.session.request(method, url, params=params, json=json,
+                                                headers=request_headers, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                src.metrics.GRAPH_REQUESTS.inc(status='error')
+                if attempt == self.max_retries:
+                    raise GraphError(f"{method} {url} failed: {e}")
+                delay = self.retry_delay(None, attempt)
+                src.logger.logger.warning(f"{method} {url} failed ({e}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+            src.metrics.GRAPH_REQUESTS.inc(status=str(response.status_code))
+            if response.status_code in (429, 503):
+                src.metrics.GRAPH_THROTTLED.inc()
+            if response.status_code == 401 and hasattr(self.access_token, 'invalidate') and not token_retried:
+                src.logger.logger.warning(f"{method} {url} returned 401, retrying with a new token")
+                self.access_token.invalidate()
+                token_retried = True
+                continue
+            if response.status_code not in RETRY_STATUS or attempt == self.max_retries:
+                return response
+            delay = self.retry_delay(response, attempt)
+            src.logger.logger.warning(f"{method} {url} returned {response.status_code}, retrying in {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
+
+    def token(self):
+        if hasattr(self.access_token, 'get'):
+            return self.access_token.get()
+        return self.access_token
+
+    def get(self, path, params=None, headers=None):
+        return self.request('GET', path, params=params, headers=headers)
+
+    # GET a JSON document, raising GraphError unless the request succeeded
+    def get_json(self, path, params=None, headers=None):
+        response = self.get(path, params=params, headers=headers)
+        check_response(response, f"GET {self.url(path)}")
+        return response.json()
+
+    # Follow @odata.nextLink and yield a collection one page at a time
+    def iter_pages(self, path, params=None, headers=None):
+        url = path
+        while url:
+            data = self.get_json(url, params=params, headers=headers)
+            yield data.get('value', [])
+            url = data.get('@odata.nextLink')
+            params = None  # the nextLink already carries the query
+
+    # Follow @odata.nextLink and return every item of a collection
+    def get_all(self, path, params=None, headers=None):
+        items = []
+        for page in self.iter_pages(path, params=params, headers=headers):
+            items.extend(page)
+        return items
+
+    # Make a Graph relative URL (as $batch wants) out of a path or nextLink
+    def relative_url(self, url):
+        if url.startswith(self.base_url):
+            url = url[len(self.base_url):]
+        return url if url.startswith('/') else f"/{url}"
+
+    # Run GET sub-requests through the JSON $batch endpoint, 20 per POST.
+    # sub_requests maps a caller chosen id to a URL; the result maps the same ids
+    # to the sub-responses. Only throttled or failed sub-requests are retried.
+    def batch(self, sub_requests, headers=None):
+        responses = {}
+        pending = dict(sub_requests)
+        for attempt in range(self.max_retries + 1):
+            retry = {}
+            retry_after = 0.0
+            ids = list(pending)
+            for i in range(0, len(ids), BATCH_SIZE):
+                chunk = ids[i:i + BATCH_SIZE]
+                body = {'requests': [
+                    {'id': str(n), 'method': 'GET', 'url': self.relative_url(pending[request_id]),
+                     **({'headers': headers} if headers else {})}
+                    for n, request_id in enumerate(chunk)
+                ]}
+                if self.rate_limiter and len(chunk) > 1:
+                    # every sub-request counts against the Graph quota
+                    self.rate_limiter.acquire(len(chunk) - 1)
+                response = self.request('POST', '/$batch', json=body)
+                check_response(response, "POST /$batch")
+                for item in response.json().get('responses', []):
+                    request_id = chunk[int(item['id'])]
+                    if item.get('status') in (429, 503):
+                        src.metrics.GRAPH_THROTTLED.inc()
+                    if item.get('status') in RETRY_STATUS:
+                        retry[request_id] = pending[request_id]
+                        try:
+                            retry_after = max(retry_after, float((item.get('headers') or {}).get('Retry-After', 0)))
+                        except ValueError:
+                            pass
+                    else:
+                        responses[request_id] = item
+            if not retry:
+                return responses
+            if attempt == self.max_retries:
+                raise GraphThrottledError(f"{len(retry)} batched requests still throttled after {self.max_retries} retries", 429)
+            pending = retry
+            delay = retry_after + random.uniform(0, 1) if retry_after else self.retry_delay(None, attempt)
+            src.logger.logger.warning(f"{len(retry)} batched requests throttled, retrying in {delay:.1f}s")
+            time.sleep(delay)
+        return responses
+
+# Iterate over pages fetched by a background thread, so the next page is
+# downloaded while the caller works on the current one. At most depth pages
+# wait in the queue; errors from the fetch are raised in the caller.
+def prefetch(pages, depth=1):
+    queue = Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.5)
+                return True
+            except Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for page in pages:
+                if not put((page, None)):
+                    return
+        except Exception as e:
+            put((done, e))
+            return
+        put((done, None))
+
+    # the producer keeps the caller's context (metrics target, log cycle id)
+    context = contextvars.copy_context()
+    thread = threading.Thread(target=context.run, args=(produce,), name='graph-prefetch', daemon=True)
+    thread.start()
+    try:
+        while True:
+            page, error = queue.get()
+            if page is done:
+                if error:
+                    raise error
+                return
+            yield page
+    finally:
+        stop.set()
+
+# Raise the appropriate GraphError for an unsuccessful response
+def check_response(response, what):
+    if response.status_code < 400:
+        return
+    message = f"{what} failed: {response.status_code} - {response.text}"
+    if response.status_code in (429, 503):
+        raise GraphThrottledError(message, response.status_code)
+    raise GraphError(message, response.status_code)
+
+# Same as check_response, for a sub-response of a $batch request
+def check_batch_response(item, what):
+    status = item.get('status', 0)
+    if status < 400:
+        return
+    message = f"{what} failed: {status} - {item.get('body')}"
+    if status in (429, 503):
+        raise GraphThrottledError(message, status)
+    raise GraphError(message, status)
+
+# Create a Graph client using the optional [azure_ad] tuning keys
+def get_graph_client(config, access_token, session=None):
+    rate_limit = config.get('azure_ad', 'rate_limit')
+    return GraphClient(
+        access_token,
+        timeout=config.get('azure_ad', 'timeout'),
+        max_retries=config.get('azure_ad', 'max_retries'),
+        pool_size=max(DEFAULT_POOL_SIZE, config.get('azure_ad', 'concurrency')),
+        rate_limiter=RateLimiter(rate_limit) if rate_limit else None,
+        session=session,
+    )
@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# Azure AD user/group FreeIPA sync utility
+# Copyright (c) 2024 Jackson Tong, Creekside Networks LLC.
+#
+# Resolution of the mirrored Azure AD groups to the users they contain,
+# nested groups included. Graph flattens a group server side through
+# /groups/{id}/transitiveMembers/microsoft.graph.user; where that is not
+# available the group graph is expanded here, fetching the direct members of
+# every group reached once per cycle. Resolved sets are kept in the state
+# store with the ids of the groups they were built from, and are reused until
+# the groups delta query reports a change to one of those groups.
+
+import src.aad
+import src.graph
+import src.logger
+import src.metrics
+
+# Only what the group sync reads of a member
+MEMBER_SELECT = 'id,userPrincipalName'
+USER_TYPE = '#microsoft.graph.user'
+GROUP_TYPE = '#microsoft.graph.group'
+# the type cast on transitiveMembers is an advanced query
+TRANSITIVE_HEADERS = {'ConsistencyLevel': 'eventual'}
+# state store key of the groups deltaLink
+GROUPS_DELTA_LINK = 'groups_delta_link'
+
+def member_entry(member):
+    return {'id': member.get('id'), 'userPrincipalName': member.get('userPrincipalName')}
+
+# Drop the cached sets built from groups changed since the last cycle. If the
+# changes can't be read no cached set is trusted.
+def invalidate_changed(client, state):
+    try:
+        changed, delta_link = src.aad.get_aad_group_changes(client, state.get_meta(GROUPS_DELTA_LINK))
+    except src.graph.GraphThrottledError:
+        raise
+    except src.graph.GraphError as e:
+        src.logger.logger.warning(f"Group changes unavailable, resolving every group again: {e}")
+        state.drop_group_members()
+        return
+    state.drop_group_members(changed)
+    # the link is taken before resolving, so changes made meanwhile show up next cycle
+    state.set_meta(GROUPS_DELTA_LINK, delta_link)
+
+# Let Graph flatten the groups: their users, and the nested groups the
+# result depends on. Returns a dict mapping group id to (group ids, users).
+def resolve_transitive(client, group_ids, concurrency):
+    groups = [{'id': group_id} for group_id in group_ids]
+    users = src.aad.crawl_group_members(client, groups, concurrency, 'transitiveMembers/microsoft.graph.user',
+                                        MEMBER_SELECT, TRANSITIVE_HEADERS)
+    nested = src.aad.crawl_group_members(client, groups, concurrency, 'transitiveMembers/microsoft.graph.group',
+                                         'id', TRANSITIVE_HEADERS)
+    return {
+        group_id: ({group_id} | {group['id'] for group in nested[group_id]},
+                   [member_entry(user) for user in users[group_id]])
+        for group_id in group_ids
+    }
+
+# Expand the groups here. The direct members of each group are fetched once,
+# level by level, however many parents share it; each group is then walked
+# with a set of the groups already entered, which also stops at cycles.
+# Returns a dict mapping group id to (group ids, users).
+def resolve_recursive(client, group_ids, concurrency):
+    direct = {}
+    frontier = set(group_ids)
+    while frontier:
+        fetched = src.aad.crawl_group_members(client, [{'id': group_id} for group_id in sorted(frontier)],
+                                              concurrency, select=MEMBER_SELECT)
+        direct.update(fetched)
+        frontier = {member['id'] for members in fetched.values() for member in members
+                    if member.get('@odata.type') == GROUP_TYPE} - direct.keys()
+
+    resolved = {}
+    for group_id in group_ids:
+        seen = {group_id}
+        stack = [group_id]
+        users = {}
+        while stack:
+            for member in direct[stack.pop()]:
+                if member.get('@odata.type') == USER_TYPE:
+                    users[member['id']] = member_entry(member)
+                elif member.get('@odata.type') == GROUP_TYPE and member['id'] not in seen:
+                    seen.add(member['id'])
+                    stack.append(member['id'])
+        resolved[group_id] = (seen, list(users.values()))
+    return resolved
+
+# Resolve groups to their users, nested groups included, from the state store
+# where nothing changed. Returns a dict mapping group id to a list of
+# {'id', 'userPrincipalName'} dicts.
+@src.metrics.timed('graph_groups')
+def resolve_group_users(client, state, groups, concurrency=src.graph.DEFAULT_CONCURRENCY):
+    invalidate_changed(client, state)
+    resolved = {}
+    pending = []
+    for group in groups:
+        cached = state.get_group_members(group['id'])
+        if cached is None:
+            pending.append(group['id'])
+        else:
+            resolved[group['id']] = cached[1]
+
+    if pending:
+        try:
+            fresh = resolve_transitive(client, pending, concurrency)
+        except src.graph.GraphThrottledError:
+            raise
+        except src.graph.GraphError as e:
+            src.logger.logger.warning(f"Transitive members unavailable, expanding nested groups locally: {e}")
+            fresh = resolve_recursive(client, pending, concurrency)
+        for group_id, (group_ids, users) in fresh.items():
+            state.put_group_members(group_id, group_ids, users)
+            resolved[group_id] = users
+    state.commit()
+
+    src.logger.logger.info(f"Resolved {len(groups)} groups, {len(groups) - len(pending)} unchanged since the last cycle")
+    return resolved
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# Azure AD user/group FreeIPA sync utility
+# Copyright (c) 2024 Jackson Tong, Creekside Networks LLC.
+
+import os
+import fcntl
+import ldap3
+from contextlib import contextmanager
+
+import src.logger
+import src.freeIPA
+import src.metrics
+
+DEFAULT_BLOCK_SIZE = 100
+
+# FreeIPA keeps the replica's next free POSIX id in the DNA plugin config
+DNA_POSIX_IDS_DN = 'cn=Posix IDs,cn=Distributed Numeric Assignment Plugin,cn=plugins,cn=config'
+
+class IdAllocatorError(Exception):
+    """Raised when no more UID/GID numbers can be allocated."""
+    pass
+
+# Hand out UID/GID numbers from blocks reserved by reserve_block(). With a
+# block_file the unused rest of the current block is kept there, so the next
+# cycle (or run) carries on with it instead of reserving a new block.
+class IdAllocator:
+    block_size = 1
+
+    def __init__(self, block_file=None):
+        self.block_file = block_file
+        self.next_free = None
+        self.block_end = None
+        self.load_block()
+
+    def reserve_block(self, size):
+        raise NotImplementedError
+
+    def load_block(self):
+        if not self.block_file or not os.path.exists(self.block_file):
+            return
+        with open(self.block_file, 'r') as f:
+            parts = f.read().split()
+        if len(parts) == 2:
+            self.next_free, self.block_end = (int(part) for part in parts)
+
+    # Written before an id is handed out, so a crash can waste an id but
+    # never hand the same one out twice
+    def save_block(self):
+        if not self.block_file:
+            return
+        tmp_file = f"{self.block_file}.tmp"
+        with open(tmp_file, 'w') as f:
+            f.write(f"{self.next_free} {self.block_end}")
+        os.replace(tmp_file, self.block_file)
+
+    @src.metrics.timed('uid_allocation')
+    def next_id(self):
+        if self.next_free is None or self.next_free > self.block_end:
+            self.next_free, self.block_end = self.reserve_block(self.block_size)
+        next_id = self.next_free
+        self.next_free += 1
+        self.save_block()
+        return next_id
+
+    # Take up to count ids left in the current block, as a (start, end)
+    # block, or None if it is used up
+    def take_remaining(self, count):
+        if self.next_free is None or self.next_free > self.block_end or count <= 0:
+            return None
+        start = self.next_free
+        end = min(self.block_end, start + count - 1)
+        self.next_free = end + 1
+        self.save_block()
+        return start, end
+
+# Read/write an integer state file under an exclusive lock, so sync
+# processes on the same host take turns with it
+@contextmanager
+def locked_counter(state_file):
+    with open(f"{state_file}.lock", 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            value = None
+            if os.path.exists(state_file):
+                with open(state_file, 'r') as f:
+                    content = f.read().strip()
+                value = int(content) if content else None
+            holder = {'value': value}
+            yield holder
+            if holder['value'] != value:
+                tmp_file = f"{state_file}.tmp"
+                with open(tmp_file, 'w') as f:
+                    f.write(str(holder['value']))
+                os.replace(tmp_file, state_file)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+# Reserve size ids from the FreeIPA DNA plugin, starting no lower than floor,
+# with a compare-and-swap on dnaNextValue: the delete fails if another process
+# (on any host) or FreeIPA itself moved it since we read it, in which case we
+# try again. Returns the (start, end) block.
+def claim_dna_block(conn, size, floor=None):
+    for _ in range(10):
+        conn.search(
+            search_base=DNA_POSIX_IDS_DN,
+            search_filter='(objectClass=*)',
+            search_scope=ldap3.BASE,
+            attributes=['dnaNextValue', 'dnaMaxValue']
+        )
+        src.metrics.count_ldap('search', conn.result)
+        if not conn.entries:
+            raise IdAllocatorError(f"DNA configuration not found: {DNA_POSIX_IDS_DN}")
+        entry = conn.entries[0].entry_attributes_as_dict
+        next_value = int(entry['dnaNextValue'][0])
+        max_value = int(entry['dnaMaxValue'][0])
+        start = max(next_value, floor) if floor is not None else next_value
+        end = min(start + size - 1, max_value)
+        if start > max_value:
+            raise IdAllocatorError(f"DNA range is exhausted at {max_value}")
+        conn.modify(DNA_POSIX_IDS_DN, {'dnaNextValue': [
+            (ldap3.MODIFY_DELETE, [str(next_value)]),
+            (ldap3.MODIFY_ADD, [str(end + 1)])
+        ]})
+        src.metrics.count_ldap('modify', conn.result)
+        if conn.result['result'] == 0:
+            src.logger.logger.info(f"Reserved UID/GID block {start}-{end} from DNA")
+            return start, end
+    raise IdAllocatorError("Could not reserve a UID/GID block from DNA, too much contention")
+
+# Persisted high-water mark: only ids above the last one handed out are
+# searched, so each allocation is one small search instead of a full scan.
+# The block above it is then claimed from DNA, so sync processes on other
+# hosts (and FreeIPA's own allocations) never get the same ids.
+class HighWaterAllocator(IdAllocator):
+
+    def __init__(self, conn, base_dn, state_file, block_size=DEFAULT_BLOCK_SIZE):
+        super().__init__(f"{state_file}.block")
+        self.conn = conn
+        self.base_dn = base_dn
+        self.state_file = state_file
+        self.block_size = block_size
+
+    def highest_id_from(self, first_id):
+        search_filter = f'(|(uidNumber>={first_id})(gidNumber>={first_id}))'
+        highest = first_id - 1
+        for dn, raw in src.freeIPA.stream_search(self.conn, self.base_dn, search_filter, ['uidNumber', 'gidNumber']):
+            for attr in ('uidNumber', 'gidNumber'):
+                value = src.freeIPA.raw_value(raw, attr)
+                if value is not None:
+                    highest = max(highest, int(value))
+        return highest
+
+    def reserve_block(self, size):
+        with locked_counter(self.state_file) as counter:
+            if counter['value'] is None:
+                # first run: one full scan to establish the high-water mark
+                last_id = src.freeIPA.get_next_uid_number(self.conn, self.base_dn) - 1
+            else:
+                last_id = self.highest_id_from(counter['value'] + 1)
+            start, end = claim_dna_block(self.conn, size, floor=last_id + 1)
+            counter['value'] = end
+        return start, end
+
+# Reserve blocks from a configured id range (tracked in a local state file)
+# or, without one, from the FreeIPA DNA plugin with an atomic LDAP update
+class RangeAllocator(IdAllocator):
+
+    def __init__(self, conn, state_file, id_range=None, block_size=DEFAULT_BLOCK_SIZE):
+        super().__init__(f"{state_file}.block")
+        self.conn = conn
+        self.state_file = state_file
+        self.id_range = id_range
+        self.block_size = block_size
+        # a block left from before the range was changed is not used
+        if id_range and self.next_free is not None and not id_range[0] <= self.next_free <= self.block_end <= id_range[1]:
+            self.next_free = self.block_end = None
+
+    def reserve_block(self, size):
+        if self.id_range:
+            return self.reserve_from_range(size)
+        return self.reserve_from_dna(size)
+
+    def reserve_from_range(self, size):
+        range_start, range_end = self.id_range
+        with locked_counter(self.state_file) as counter:
+            start = counter['value'] if counter['value'] is not None else range_start
+            start = max(start, range_start)
+            end = min(start + size - 1, range_end)
+            if start > range_end:
+                raise IdAllocatorError(f"ID range {range_start}-{range_end} is exhausted")
+            counter['value'] = end + 1
+        src.logger.logger.info(f"Reserved UID/GID block {start}-{end}")
+        return start, end
+
+    def reserve_from_dna(self, size):
+        return claim_dna_block(self.conn, size)
+
+# Hand out ids only from blocks reserved up front by another allocator, as
+# given to the workers of a sharded sync
+class PreassignedAllocator(IdAllocator):
+
+    def __init__(self, blocks):
+        super().__init__()
+        self.blocks = list(blocks)
+
+    def reserve_block(self, size):
+        if not self.blocks:
+            raise IdAllocatorError("Pre-assigned UID/GID blocks are exhausted")
+        return self.blocks.pop(0)
+
+# Reserve count ids from allocator, in as many blocks as it takes, starting
+# with what is left of its current block
+def reserve_ids(allocator, count):
+    blocks = []
+    remaining = allocator.take_remaining(count)
+    if remaining:
+        blocks.append(remaining)
+        count -= remaining[1] - remaining[0] + 1
+    while count > 0:
+        start, end = allocator.reserve_block(count)
+        blocks.append((start, end))
+        count -= end - start + 1
+    return blocks
+
+# Parse an id range such as "200000-299999"
+def parse_id_range(value):
+    if not value:
+        return None
+    start, end = (int(part) for part in value.split('-', 1))
+    if start > end:
+        raise ValueError(f"Invalid id range: {value}")
+    return start, end
+
+# Create the allocator selected by [freeipa] id_allocator (highwater or range)
+def get_id_allocator(config, conn, base_dn, state_dir):
+    mode = config.get('freeipa', 'id_allocator')
+    if mode == 'highwater':
+        return HighWaterAllocator(conn, base_dn, os.path.join(state_dir, '.id_highwater'),
+                                  block_size=config.get('freeipa', 'id_block_size'))
+    if mode == 'range':
+        return RangeAllocator(
+            conn,
+            os.path.join(state_dir, '.id_range'),
+            id_range=parse_id_range(config.get('freeipa', 'id_range')),
+            block_size=config.get('freeipa', 'id_block_size')
+        )
+    raise ValueError(f"Unknown id allocator: {mode}")
@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# Azure AD user/group FreeIPA sync utility
+# Copyright (c) 2024 Jackson Tong, Creekside Networks LLC.
+#
+# Near-real-time provisioning from Microsoft Graph change notifications: a
+# small HTTP receiver for notifications on users plus the subscription that
+# makes Graph send them. The ids of changed users are queued so they can be
+# synced right away; the periodic full reconcile remains as a safety net.
+
+import json
+import time
+import secrets
+import threading
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import src.logger
+import src.graph
+
+DEFAULT_PORT = 8765
+# Graph allows up to 41760 minutes for users; renew well before it lapses
+SUBSCRIPTION_LIFETIME = timedelta(days=2)
+SUBSCRIPTION_RENEW_BEFORE = timedelta(hours=12)
+
+class NotificationHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body=b'', content_type='text/plain'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        listener = self.server.listener
+        parts = urlsplit(self.path)
+        if parts.path != listener.path:
+            self.reply(404)
+            return
+
+        # subscription validation handshake: echo the token back as plain text
+        validation_token = parse_qs(parts.query).get('validationToken')
+        if validation_token:
+            self.reply(200, validation_token[0].encode('utf-8'))
+            return
+
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            payload = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self.reply(400)
+            return
+        # answer quickly, Graph retries and eventually drops slow endpoints
+        self.reply(202)
+        listener.accept(payload.get('value', []))
+
+# HTTP receiver for Graph change notifications on users
+class NotificationListener:
+
+    def __init__(self, port=DEFAULT_PORT, address='0.0.0.0', path='/notifications', client_state=None):
+        self.path = path
+        self.client_state = client_state or secrets.token_urlsafe(24)
+        self.pending = set()
+        self.condition = threading.Condition()
+        self.server = ThreadingHTTPServer((address, port), NotificationHandler)
+        self.server.daemon_threads = True
+        self.server.listener = self
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever, name='notifications', daemon=True)
+        thread.start()
+        src.logger.logger.info(f"Listening for Graph change notifications on port {self.server.server_address[1]}")
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # Queue the user ids of notifications carrying our clientState
+    def accept(self, notifications):
+        object_ids = set()
+        for notification in notifications:
+            if notification.get('clientState') != self.client_state:
+                src.logger.logger.warning("Ignoring change notification with an unknown clientState")
+                continue
+            object_id = (notification.get('resourceData') or {}).get('id')
+            if object_id:
+                object_ids.add(object_id)
+        if object_ids:
+            with self.condition:
+                self.pending |= object_ids
+                self.condition.notify_all()
+
+    # Wait until some users changed or the timeout passed; returns their ids
+    def wait(self, timeout):
+        with self.condition:
+            if not self.pending:
+                self.condition.wait(timeout)
+            object_ids, self.pending = self.pending, set()
+        return object_ids
+
+# The Graph subscription that delivers user change notifications to the
+# listener, created on first use and renewed before it expires
+class Subscription:
+
+    def __init__(self, client, notification_url, client_state):
+        self.client = client
+        self.notification_url = notification_url
+        self.client_state = client_state
+        self.subscription_id = None
+        self.expires = None
+
+    def ensure(self):
+        now = datetime.now(timezone.utc)
+        if self.subscription_id and self.expires - now > SUBSCRIPTION_RENEW_BEFORE:
+            return
+        expires = now + SUBSCRIPTION_LIFETIME
+        expiration = expires.strftime('%Y-%m-%dT%H:%M:%S.0000000Z')
+        if self.subscription_id:
+            response = self.client.request('PATCH', f'/subscriptions/{self.subscription_id}',
+                                           json={'expirationDateTime': expiration})
+            if response.status_code == 200:
+                self.expires = expires
+                src.logger.logger.info(f"Renewed Graph subscription {self.subscription_id} until {expiration}")
+                return
+            # gone or rejected: fall through and create a new one
+            src.logger.logger.warning(f"Could not renew Graph subscription: {response.status_code} - {response.text}")
+            self.subscription_id = None
+
+        response = self.client.request('POST', '/subscriptions', json={
+            'changeType': 'created,updated,deleted',
+            'notificationUrl': self.notification_url,
+            'resource': 'users',
+            'expirationDateTime': expiration,
+            'clientState': self.client_state,
+        })
+        src.graph.check_response(response, "Creating Graph subscription")
+        self.subscription_id = response.json()['id']
+        self.expires = expires
+        src.logger.logger.info(f"Created Graph subscription {self.subscription_id} until {expiration}")
+
+    def delete(self):
+        if not self.subscription_id:
+            return
+        try:
+            self.client.request('DELETE', f'/subscriptions/{self.subscription_id}')
+        except src.graph.GraphError as e:
+            src.logger.logger.warning(f"Could not delete Graph subscription: {e}")
+        self.subscription_id = None
+
+# Handle change notifications until deadline (a time.monotonic() value):
+# handler is called with each batch of changed user ids as it arrives
+def serve_until(listener, subscription, deadline, handler):
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        try:
+            subscription.ensure()
+        except src.graph.GraphError as e:
+            src.logger.logger.error(f"Graph subscription failed: {e}")
+        object_ids = listener.wait(min(remaining, 60))
+        if object_ids:
+            handler(object_ids)
@@ -21,35 +21,125 @@
 # OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
 # WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+# Records are handed to a queue and written by a single listener thread,
+# so the sync never waits on disk and only one handler rotates the file.
+# Log with %-style arguments (logger.debug("... %s", value)) on hot paths:
+# the message is then only formatted if the level is enabled.
+
+import json
+import queue
+import contextvars
 import logging
 import os
-from logging.handlers import RotatingFileHandler
+from datetime import datetime, timezone
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
+
+LOGGER_NAME = 'AAD->IPA'
+# extra fields carried into the JSON lines output
+EXTRA_FIELDS = ('phase', 'seconds', 'object_id', 'uid')
 
 logger = None
+listener = None
+# id of the sync cycle the current thread is running
+CYCLE = contextvars.ContextVar('cycle', default=None)
+
+# Tag every record with the id of the sync cycle it was logged in
+class CycleFilter(logging.Filter):
+
+    def filter(self, record):
+        # records forwarded from worker processes already carry theirs
+        if not hasattr(record, 'cycle'):
+            record.cycle = CYCLE.get()
+        return True
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'cycle': getattr(record, 'cycle', None),
+        }
+        for field in EXTRA_FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+def set_cycle(value):
+    CYCLE.set(value)
+
+def current_cycle():
+    return CYCLE.get()
+
+# Log how long a sync phase took; a no-op unless DEBUG is enabled
+def log_phase(phase, seconds):
+    if logger is not None and logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Phase %s took %.3f seconds", phase, seconds, extra={'phase': phase, 'seconds': round(seconds, 3)})
 
-def get_logger(log_dir):
-    logger = logging.getLogger('AAD->IPA')
+def get_logger(log_dir, level='INFO', json_format=False):
+    global listener
+    logger = logging.getLogger(LOGGER_NAME)
     if not logger.hasHandlers():
-        logger.setLevel(logging.INFO)
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-        
+        logger.setLevel(getattr(logging, str(level).upper(), logging.INFO))
+        if json_format:
+            formatter = JsonFormatter()
+        else:
+            formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
         if not os.path.exists(log_dir):
             os.makedirs(log_dir)
-        
+
         log_file = os.path.join(log_dir, 'aad_freeipa_sync.log')
-        file_handler = logging.FileHandler(log_file)
-        file_handler.setFormatter(formatter)
-        logger.addHandler(file_handler)
-        
+        rotating_handler = RotatingFileHandler(log_file, maxBytes=5000000, backupCount=5)
+        rotating_handler.setFormatter(formatter)
+
         console_handler = logging.StreamHandler()
         console_handler.setFormatter(formatter)
-        logger.addHandler(console_handler)
 
-        rotating_handler = RotatingFileHandler(log_file, maxBytes=5000000, backupCount=5)
-        rotating_handler.setFormatter(formatter)
-        logger.addHandler(rotating_handler)
+        log_queue = queue.SimpleQueue()
+        queue_handler = QueueHandler(log_queue)
+        queue_handler.addFilter(CycleFilter())
+        logger.addHandler(queue_handler)
+        listener = QueueListener(log_queue, rotating_handler, console_handler)
+        listener.start()
 
     return logger
 
+# Flush queued records and stop the writer thread
+def stop_logging():
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+# Forward records from worker processes to this process's logger
+class ForwardHandler(logging.Handler):
+
+    def handle(self, record):
+        target = logging.getLogger(record.name)
+        if target.isEnabledFor(record.levelno):
+            target.handle(record)
+        return True
 
+# Queue and listener collecting the log records of worker processes
+def worker_log_queue(context):
+    log_queue = context.Queue()
+    worker_listener = QueueListener(log_queue, ForwardHandler())
+    worker_listener.start()
+    return log_queue, worker_listener
 
+# Process initializer for workers: log through log_queue to the parent
+def init_worker_logging(log_queue, level, cycle):
+    global logger
+    set_cycle(cycle)
+    worker_logger = logging.getLogger(LOGGER_NAME)
+    worker_logger.handlers.clear()
+    worker_logger.setLevel(level)
+    queue_handler = QueueHandler(log_queue)
+    queue_handler.addFilter(CycleFilter())
+    worker_logger.addHandler(queue_handler)
+    logger = worker_logger
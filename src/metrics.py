@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# Azure AD user/group FreeIPA sync utility
+# Copyright (c) 2024 Jackson Tong, Creekside Networks LLC.
+#
+# Minimal Prometheus metrics: counters and histograms rendered in the text
+# exposition format, served on a local /metrics port or written to a file for
+# the node_exporter textfile collector.
+
+import os
+import time
+import inspect
+import threading
+import contextvars
+import functools
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import src.logger
+
+# Sync target (tenant/realm pair) the current thread works for; added as a
+# 'target' label to every metric when several targets share the process
+TARGET = contextvars.ContextVar('target', default='')
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, float('inf'))
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# empty label values are left out, which Prometheus treats the same
+def format_labels(labels):
+    labels = [(key, value) for key, value in labels if value != '']
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{escape_label(value)}"' for key, value in labels) + '}'
+
+def label_key(labelnames, labels):
+    return (('target', TARGET.get()),) + tuple((name, labels.get(name, '')) for name in labelnames)
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = label_key(self.labelnames, labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(key)} {format_value(value)}")
+        return lines
+
+class Histogram:
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = label_key(self.labelnames, labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{format_labels(key + (('le', format_value(bound)),))} {count}")
+                lines.append(f"{self.name}_sum{format_labels(key)} {total}")
+                lines.append(f"{self.name}_count{format_labels(key)} {counts[-1]}")
+        return lines
+
+PHASE_SECONDS = Histogram('aad_sync_phase_duration_seconds', 'Duration of sync phases', ['phase'])
+GRAPH_REQUESTS = Counter('aad_sync_graph_requests_total', 'Microsoft Graph HTTP requests by status', ['status'])
+GRAPH_THROTTLED = Counter('aad_sync_graph_throttled_total', 'Microsoft Graph requests answered with 429 or 503')
+LDAP_OPERATIONS = Counter('aad_sync_ldap_operations_total', 'LDAP operations sent to FreeIPA', ['operation'])
+LDAP_ERRORS = Counter('aad_sync_ldap_errors_total', 'LDAP operations that failed', ['operation'])
+USERS_CREATED = Counter('aad_sync_users_created_total', 'Users created in FreeIPA')
+USERS_UPDATED = Counter('aad_sync_users_updated_total', 'Users updated in FreeIPA')
+USERS_DEPROVISIONED = Counter('aad_sync_users_deprovisioned_total', 'Users locked or preserved in FreeIPA', ['action'])
+
+METRICS = [PHASE_SECONDS, GRAPH_REQUESTS, GRAPH_THROTTLED, LDAP_OPERATIONS, LDAP_ERRORS, USERS_CREATED, USERS_UPDATED,
+           USERS_DEPROVISIONED]
+
+# Count an LDAP operation and, if its result is not success, an error
+def count_ldap(operation, result=None):
+    LDAP_OPERATIONS.inc(operation=operation)
+    if result is not None and result.get('result') != 0:
+        LDAP_ERRORS.inc(operation=operation)
+
+# Decorator recording a function's run time as a sync phase; for generators
+# only the time spent producing items is recorded, once they are exhausted
+def timed(phase):
+    def decorator(func):
+        if inspect.isgeneratorfunction(func):
+            @functools.wraps(func)
+            def generator_wrapper(*args, **kwargs):
+                elapsed = 0.0
+                iterator = func(*args, **kwargs)
+                try:
+                    while True:
+                        started = time.monotonic()
+                        try:
+                            item = next(iterator)
+                        except StopIteration:
+                            return
+                        finally:
+                            elapsed += time.monotonic() - started
+                        yield item
+                finally:
+                    PHASE_SECONDS.observe(elapsed, phase=phase)
+                    src.logger.log_phase(phase, elapsed)
+            return generator_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.monotonic()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.monotonic() - started
+                PHASE_SECONDS.observe(elapsed, phase=phase)
+                src.logger.log_phase(phase, elapsed)
+        return wrapper
+    return decorator
+
+def render():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        payload = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+# Serve /metrics from a background thread
+def start_http_server(port, address='127.0.0.1'):
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+    thread.start()
+    return server
+
+# Write the metrics for the node_exporter textfile collector, atomically
+def write_textfile(path):
+    tmp_file = f"{path}.tmp"
+    with open(tmp_file, 'w') as f:
+        f.write(render())
+    os.replace(tmp_file, path)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# Azure AD user/group FreeIPA sync utility
+# Copyright (c) 2024 Jackson Tong, Creekside Networks LLC.
+#
+# When to run the next sync cycle. The interval is measured from the start
+# of a cycle, start times are jittered so instances restarted together drift
+# apart, a cycle that left work behind is followed right away and repeated
+# failures back off exponentially. A lock file keeps two instances from
+# syncing the same FreeIPA at once.
+
+import os
+import fcntl
+import random
+import hashlib
+import tempfile
+import time
+
+import src.logger
+
+DEFAULT_JITTER = 0.1
+DEFAULT_MAX_BACKOFF = 3600
+# consecutive immediate reruns before falling back to the interval, so a
+# backlog that never clears can't turn into a hot loop
+MAX_BACKLOG_RUNS = 3
+
+# Outcome of a cycle
+OK = 'ok'
+BACKLOG = 'backlog'
+FAILED = 'failed'
+
+class SchedulerError(Exception):
+    pass
+
+class Scheduler:
+
+    def __init__(self, interval, jitter=DEFAULT_JITTER, max_backoff=DEFAULT_MAX_BACKOFF):
+        self.interval = interval
+        self.jitter = jitter
+        self.max_backoff = max(max_backoff, interval)
+        self.failures = 0
+        self.backlog_runs = 0
+        self.started = None
+
+    # Random offset of up to jitter * interval seconds
+    def jittered(self, delay):
+        return delay + random.uniform(0, self.jitter * self.interval)
+
+    # Deadline (a time.monotonic() value) of the first cycle after startup
+    def first_run(self):
+        return time.monotonic() + random.uniform(0, self.jitter * self.interval)
+
+    def cycle_started(self):
+        self.started = time.monotonic()
+
+    # Record how the cycle went; returns the deadline of the next one
+    def cycle_finished(self, outcome):
+        if outcome == FAILED:
+            self.failures += 1
+            self.backlog_runs = 0
+            delay = min(self.interval * 2 ** (self.failures - 1), self.max_backoff)
+            if self.failures > 1:
+                src.logger.logger.warning(f"{self.failures} sync cycles failed in a row, next one in {delay} seconds")
+            return self.started + self.jittered(delay)
+
+        self.failures = 0
+        if outcome == BACKLOG and self.backlog_runs < MAX_BACKLOG_RUNS:
+            self.backlog_runs += 1
+            src.logger.logger.info("Sync cycle left a backlog, running the next one now")
+            return time.monotonic()
+        self.backlog_runs = 0
+        return self.started + self.jittered(self.interval)
+
+# Exclusive advisory lock held for as long as the sync runs against a target
+class RunLock:
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    def acquire(self):
+        self.file = open(self.path, 'a+')
+        try:
+            fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            self.file.seek(0)
+            owner = self.file.read().strip()
+            self.file.close()
+            self.file = None
+            raise SchedulerError(f"Another sync (pid {owner or 'unknown'}) holds {self.path}")
+        self.file.seek(0)
+        self.file.truncate()
+        self.file.write(str(os.getpid()))
+        self.file.flush()
+        return self
+
+    def release(self):
+        if self.file:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+            self.file.close()
+            self.file = None
+
+# Host-wide directory for lock files, so installs with separate config dirs
+# that point at the same FreeIPA still find each other's lock
+def default_lock_dir():
+    return '/run/lock' if os.access('/run/lock', os.W_OK) else tempfile.gettempdir()
+
+# Lock file for a FreeIPA target, named after its servers and base DN. The
+# server list is compared in any order and case, the base DN in any case.
+def lock_file_path(lock_dir, server, basedn):
+    servers = ','.join(sorted({address.strip().lower() for address in server.split(',') if address.strip()}))
+    basedn = ','.join(part.strip() for part in basedn.lower().split(','))
+    target = hashlib.sha256(f"{servers}|{basedn}".encode('utf-8')).hexdigest()[:16]
+    return os.path.join(lock_dir, f".aad_freeipa_sync.{target}.lock")
+
+# Scheduler from the [sync] section
+def get_scheduler(config):
+    return Scheduler(
+        config.get('sync', 'interval'),
+        jitter=config.get('sync', 'jitter'),
+        max_backoff=config.get('sync', 'max_backoff')
+    )
@@ -2,13 +2,26 @@
 # Azure AD user/group FreeIPA sync utility
 # Copyright (c) 2024 Jackson Tong, Creekside Networks LLC.
 
+import os
+import json
+import time
+import queue
+import random
 import smtplib
+import threading
+from datetime import datetime
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 
 import src.logger
 
-def send_email(server, port, user, password, subject, body, recipients):
+DEFAULT_TIMEOUT = 30
+DEFAULT_QUEUE_SIZE = 100
+DEFAULT_MAX_RETRIES = 5
+# an idle SMTP connection is closed before the server drops it
+SMTP_IDLE_TIMEOUT = 60
+
+def build_message(user, recipients, subject, body):
     msg = MIMEMultipart()
     msg['From'] = user
     msg['To'] = ', '.join(recipients)
@@ -26,9 +39,12 @@ def send_email(server, port, user, password, subject, body, recipients):
     </html>
     """
     msg.attach(MIMEText(html_body, 'html'))
+    return msg
 
+def send_email(server, port, user, password, subject, body, recipients, timeout=DEFAULT_TIMEOUT):
+    msg = build_message(user, recipients, subject, body)
     try:
-        server = smtplib.SMTP(server, port)
+        server = smtplib.SMTP(server, port, timeout=timeout)
         server.starttls()
         server.login(user, password)
         text = msg.as_string()
@@ -36,4 +52,194 @@ def send_email(server, port, user, password, subject, body, recipients):
         server.quit()
         src.logger.logger.info("Email sent successfully")
     except Exception as e:
-        src.logger.logger.error(f"Failed to send email: {e}")
\ No newline at end of file
+        src.logger.logger.error(f"Failed to send email: {e}")
+
+# Sends reports from a background thread so mail never holds up a sync.
+# Reports queued within digest_window seconds of each other go out as one
+# email, the SMTP connection is kept open between sends, failed sends are
+# retried with backoff and finally spooled to disk to be sent later.
+class Notifier:
+
+    def __init__(self, server, port, user, password, recipients, digest_window=0, timeout=DEFAULT_TIMEOUT,
+                 max_retries=DEFAULT_MAX_RETRIES, queue_size=DEFAULT_QUEUE_SIZE, spool_dir=None):
+        self.server = server
+        self.port = port
+        self.user = user
+        self.password = password
+        self.recipients = recipients
+        self.digest_window = digest_window
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.spool_dir = spool_dir
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.smtp = None
+        self.thread = None
+
+    def start(self):
+        if self.spool_dir:
+            # spooled reports carry the initial passwords of new users
+            os.makedirs(self.spool_dir, mode=0o700, exist_ok=True)
+            os.chmod(self.spool_dir, 0o700)
+        self.thread = threading.Thread(target=self.run, name='notifier', daemon=True)
+        self.thread.start()
+        return self
+
+    # Queue a report; never blocks, a full queue goes straight to the spool
+    def notify(self, subject, body):
+        report = {'subject': subject, 'body': body, 'created': time.time()}
+        try:
+            self.queue.put_nowait(report)
+        except queue.Full:
+            src.logger.logger.warning("Notification queue is full, spooling the report")
+            self.spool([report])
+
+    # Send what is queued, then stop the thread
+    def stop(self, timeout=None):
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join(timeout if timeout is not None else self.timeout * 2)
+        self.thread = None
+        # whatever the thread did not get to waits in the spool
+        reports = []
+        while True:
+            try:
+                report = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if report is not None:
+                reports.append(report)
+        if reports:
+            self.spool(reports)
+
+    def run(self):
+        self.send_spooled()
+        while True:
+            try:
+                report = self.queue.get(timeout=SMTP_IDLE_TIMEOUT)
+            except queue.Empty:
+                self.disconnect()
+                continue
+            if report is None:
+                break
+            reports = [report]
+            stopping = self.collect(reports)
+            self.deliver(reports)
+            if stopping:
+                break
+        self.disconnect()
+
+    # Add the reports that arrive within the digest window; returns True if
+    # stop() was called meanwhile
+    def collect(self, reports):
+        deadline = time.monotonic() + self.digest_window
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                report = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                return False
+            if report is None:
+                return True
+            reports.append(report)
+
+    def deliver(self, reports):
+        if len(reports) == 1:
+            subject, body = reports[0]['subject'], reports[0]['body']
+        else:
+            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            subject = f"AAD to FreeIPA Sync Report - {timestamp} ({len(reports)} runs)"
+            body = "\n\n".join(f"{report['subject']}\n\n{report['body']}" for report in reports)
+        if self.send(subject, body):
+            self.send_spooled()
+        else:
+            self.spool(reports)
+
+    def connect(self):
+        if self.smtp is not None:
+            try:
+                if self.smtp.noop()[0] == 250:
+                    return self.smtp
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.disconnect()
+        smtp = smtplib.SMTP(self.server, self.port, timeout=self.timeout)
+        try:
+            smtp.starttls()
+            smtp.login(self.user, self.password)
+        except Exception:
+            smtp.close()
+            raise
+        self.smtp = smtp
+        return smtp
+
+    def disconnect(self):
+        if self.smtp is None:
+            return
+        try:
+            self.smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            self.smtp.close()
+        self.smtp = None
+
+    # Send one email, retrying with exponential backoff; returns True if sent
+    def send(self, subject, body):
+        msg = build_message(self.user, self.recipients, subject, body).as_string()
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.connect().sendmail(self.user, self.recipients, msg)
+                src.logger.logger.info("Email sent successfully")
+                return True
+            except (smtplib.SMTPException, OSError) as e:
+                self.disconnect()
+                if attempt == self.max_retries:
+                    src.logger.logger.error(f"Failed to send email: {e}")
+                    return False
+                delay = min(2 ** attempt, 60) * random.uniform(0.5, 1.5)
+                src.logger.logger.warning(f"Failed to send email, retrying in {delay:.1f} seconds: {e}")
+                time.sleep(delay)
+
+    def spool(self, reports):
+        if not self.spool_dir:
+            src.logger.logger.error(f"Dropping {len(reports)} undelivered reports, no spool directory")
+            return
+        for report in reports:
+            name = f"{report['created']:.6f}-{random.randrange(1 << 32):08x}.json"
+            tmp_file = os.path.join(self.spool_dir, f".{name}.tmp")
+            with open(os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+                json.dump(report, f)
+            os.replace(tmp_file, os.path.join(self.spool_dir, name))
+        src.logger.logger.info(f"Spooled {len(reports)} reports to {self.spool_dir}")
+
+    # Send spooled reports as one digest, oldest first
+    def send_spooled(self):
+        if not self.spool_dir or not os.path.isdir(self.spool_dir):
+            return
+        names = sorted(name for name in os.listdir(self.spool_dir) if name.endswith('.json'))
+        if not names:
+            return
+        reports = []
+        for name in names:
+            try:
+                with open(os.path.join(self.spool_dir, name)) as f:
+                    reports.append(json.load(f))
+            except (OSError, ValueError) as e:
+                src.logger.logger.error(f"Skipping unreadable spooled report {name}: {e}")
+        subject = f"AAD to FreeIPA Sync Report - {len(reports)} delayed runs"
+        body = "\n\n".join(f"{report['subject']}\n\n{report['body']}" for report in reports)
+        if self.send(subject, body):
+            for name in names:
+                os.remove(os.path.join(self.spool_dir, name))
+
+# Notifier from the [mail] section
+def get_notifier(config, state_dir):
+    return Notifier(
+        server = config.get('mail', 'server'),
+        port = config.get('mail', 'port'),
+        user = config.get('mail', 'user'),
+        password = config.get('mail', 'password'),
+        recipients = config.get('mail', 'recipients'),
+        digest_window = config.get('mail', 'digest_window'),
+        timeout = config.get('mail', 'timeout'),
+        spool_dir = config.get('mail', 'spool_dir') or os.path.join(state_dir, 'mail_spool')
+    )
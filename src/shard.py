@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# Azure AD user/group FreeIPA sync utility
+# Copyright (c) 2024 Jackson Tong, Creekside Networks LLC.
+#
+# Sharded user sync for very large tenants. The coordinator lists the users
+# once, partitions them by a stable hash of their object id and hands each
+# shard to a worker process with its own FreeIPA connection and state store
+# connection. UID/GID numbers are reserved per shard up front, so workers
+# never collide, and the per-shard results are merged into one report.
+
+import os
+import zlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import src.aad
+import src.logger
+import src.freeIPA
+import src.idalloc
+import src.state
+import src.metrics
+import src.sync_user
+import src.deprovision
+
+# Shard of an Azure AD object id; the same on every run and every host
+def shard_of(object_id, shards):
+    return zlib.crc32(object_id.encode('utf-8')) % shards
+
+# Sync one shard of users in a worker process. ipa is only passed when
+# running in-process; workers open their own connection.
+def run_shard(config, state_dir, shard, users, blocks, index, ipa=None):
+    own_ipa = ipa is None
+    if own_ipa:
+        ipa = src.freeIPA.FreeIPAConnection(
+            config.get('freeipa', 'server'),
+            config.get('freeipa', 'user'),
+            config.get('freeipa', 'password')
+        )
+    state = src.state.StateStore(os.path.join(state_dir, 'aad_freeipa_sync.db'))
+    result = {}
+    try:
+        new_users = src.sync_user.sync_users(config, None, ipa, state, None, state_dir, users=users,
+                                             result=result, allocator=src.idalloc.PreassignedAllocator(blocks),
+                                             index=index)
+    finally:
+        state.close()
+        if own_ipa:
+            ipa.close()
+    src.logger.logger.info("Shard %s: %s users created, %s updated, %s failed, %s rejected",
+                           shard, result['created'], result['updated'], result['failures'], result['rejected'])
+    return new_users, result
+
+# Sync users across `shards` worker processes; same contract as
+# src.sync_user.sync_users for a full or delta cycle
+@src.metrics.timed('sharded_sync')
+def sync_users_sharded(config, client, ipa, state, delta_link_file, state_dir, shards, result=None):
+    mode = src.deprovision.deprovision_mode(config)
+    delta = None
+    if delta_link_file:
+        delta = {}
+        pages = src.aad.iter_aad_users_delta(client, src.aad.load_delta_link(delta_link_file), delta)
+    else:
+        pages = src.aad.iter_aad_users(client)
+
+    partitions = [[] for _ in range(shards)]
+    seen = set()
+    for page in pages:
+        for user in page:
+            if user.get('id'):
+                seen.add(user['id'])
+                partitions[shard_of(user['id'], shards)].append(user)
+
+    # users neither in the state store nor in FreeIPA are the ones that get
+    # created: reserve that many ids per shard, and hand each worker just
+    # its part of the user index
+    conn = ipa.ensure()
+    base_dn = f'cn=users,cn=accounts,{config.get("freeipa", "basedn")}'
+    allocator = src.idalloc.get_id_allocator(config, conn, base_dn, state_dir)
+    index = src.freeIPA.load_user_index(conn, base_dn)
+    blocks = []
+    indexes = []
+    for users in partitions:
+        shard_index = src.freeIPA.UserIndex()
+        new = 0
+        for user in users:
+            if state.get_user(user['id']) is not None or 'userPrincipalName' not in user:
+                continue
+            existing = index.get_by_uid(src.sync_user.aad_uid(user))
+            if existing:
+                shard_index.add(existing['uid'], existing['uidNumber'], existing['mail'], existing['attrs'])
+            else:
+                new += 1
+        blocks.append(src.idalloc.reserve_ids(allocator, new))
+        indexes.append(shard_index)
+
+    new_users = []
+    totals = {'created': 0, 'updated': 0, 'failures': 0, 'rejected': 0}
+    context = multiprocessing.get_context('spawn')
+    # workers log through a queue to this process's single writer
+    log_queue, log_listener = src.logger.worker_log_queue(context)
+    try:
+        with ProcessPoolExecutor(max_workers=shards, mp_context=context,
+                                 initializer=src.logger.init_worker_logging,
+                                 initargs=(log_queue, src.logger.logger.getEffectiveLevel(),
+                                           src.logger.current_cycle())) as executor:
+            futures = [executor.submit(run_shard, config, state_dir, shard, users, blocks[shard], indexes[shard])
+                       for shard, users in enumerate(partitions) if users]
+            for future in futures:
+                try:
+                    shard_users, shard_result = future.result()
+                except Exception as e:
+                    src.logger.logger.error(f"Shard worker failed: {e}")
+                    totals['failures'] += 1
+                    continue
+                new_users.extend(shard_users)
+                for key in totals:
+                    totals[key] += shard_result[key]
+    finally:
+        log_listener.stop()
+    # worker processes keep their own counters
+    src.metrics.USERS_CREATED.inc(totals['created'])
+    src.metrics.USERS_UPDATED.inc(totals['updated'])
+
+    # a delta baseline (first run or expired link) lists every user like a full sync
+    if delta is not None and not delta['baseline']:
+        removed_ids = delta['removed']
+    elif mode != 'none':
+        removed_ids = state.user_ids() - seen
+    else:
+        removed_ids = []
+    for object_id in removed_ids:
+        src.logger.logger.info("User %s was removed from Azure AD", object_id)
+    totals['failures'] += src.deprovision.deprovision_users(config, ipa, state, [], removed_ids, mode)
+
+    if delta is not None and delta['deltaLink'] and not totals['failures']:
+        src.aad.save_delta_link(delta_link_file, delta['deltaLink'])
+    if result is not None:
+        result.update(totals)
+    new_users.sort(key=lambda user: user['uidNumber'])
+    return new_users
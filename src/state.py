@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# Azure AD user/group FreeIPA sync utility
+# Copyright (c) 2024 Jackson Tong, Creekside Networks LLC.
+
+import json
+import sqlite3
+import hashlib
+
+# Azure AD user attributes mirrored into FreeIPA, and their LDAP names
+SYNCED_ATTRIBUTES = {
+    'displayName': 'cn',
+    'givenName': 'givenName',
+    'surname': 'sn',
+    'mail': 'mail',
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    object_id   TEXT PRIMARY KEY,
+    dn          TEXT NOT NULL,
+    uid         TEXT NOT NULL,
+    uid_number  INTEGER,
+    attr_hash   TEXT,
+    attrs       TEXT,
+    status      TEXT NOT NULL DEFAULT 'active'
+);
+CREATE TABLE IF NOT EXISTS groups (
+    group_id    TEXT PRIMARY KEY,
+    cn          TEXT,
+    member_hash TEXT
+);
+CREATE TABLE IF NOT EXISTS group_members (
+    group_id    TEXT PRIMARY KEY,
+    groups      TEXT NOT NULL,
+    members     TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rejected_users (
+    object_id   TEXT PRIMARY KEY,
+    attr_hash   TEXT,
+    error       TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key         TEXT PRIMARY KEY,
+    value       TEXT
+);
+"""
+
+# Account states of a synced user: active, locked in FreeIPA, or locked and
+# moved to the preserved users container
+ACTIVE = 'active'
+DISABLED = 'disabled'
+PRESERVED = 'preserved'
+
+# Digest of the synced attributes of a user
+def attributes_hash(attrs):
+    return hashlib.sha256(json.dumps(attrs, sort_keys=True).encode('utf-8')).hexdigest()
+
+# Local SQLite database mapping Azure AD object ids to the FreeIPA entries
+# they were synced to, with a hash of what was last written to each
+class StateStore:
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        # WAL lets the workers of a sharded sync write while others read
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+        # databases from before deprovisioning lack the status column
+        columns = [row['name'] for row in self.db.execute('PRAGMA table_info(users)')]
+        if 'status' not in columns:
+            self.db.execute(f"ALTER TABLE users ADD COLUMN status TEXT NOT NULL DEFAULT '{ACTIVE}'")
+        # a FreeIPA entry belongs to one object id; mappings shared before
+        # this was enforced go first
+        self.drop_shared_mappings()
+        self.db.execute('CREATE UNIQUE INDEX IF NOT EXISTS users_uid ON users (uid COLLATE NOCASE)')
+        self.db.commit()
+
+    # Keep only the first object id synced to each uid. Deprovisioning one of
+    # the others locked or moved the entry they shared, so the one kept takes
+    # over where the entry really is now and its status: enabled in Azure AD
+    # it is then reactivated, and no longer rejected for a stale DN. Its
+    # attributes are written again, over those the others left.
+    def drop_shared_mappings(self):
+        rows = self.db.execute(
+            'SELECT rowid, object_id, uid, dn, status FROM users WHERE lower(uid) IN '
+            '(SELECT lower(uid) FROM users GROUP BY lower(uid) HAVING COUNT(*) > 1) ORDER BY rowid'
+        ).fetchall()
+        owners = {}
+        for row in rows:
+            owner = owners.setdefault(row['uid'].lower(), row['object_id'])
+            if owner == row['object_id']:
+                continue
+            self.db.execute('DELETE FROM users WHERE rowid = ?', (row['rowid'],))
+            self.db.execute('UPDATE users SET attr_hash = NULL WHERE object_id = ?', (owner,))
+            if row['status'] != ACTIVE:
+                self.set_user_status(owner, row['status'], row['dn'])
+                self.clear_rejection(owner)
+
+    def get_user(self, object_id):
+        row = self.db.execute('SELECT * FROM users WHERE object_id = ?', (object_id,)).fetchone()
+        if row is None:
+            return None
+        user = dict(row)
+        user['attrs'] = json.loads(user['attrs']) if user['attrs'] else {}
+        return user
+
+    # Insert or update a user, keeping its status
+    def put_user(self, object_id, dn, uid, uid_number, attr_hash, attrs):
+        self.db.execute(
+            'INSERT INTO users (object_id, dn, uid, uid_number, attr_hash, attrs) VALUES (?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT(object_id) DO UPDATE SET dn = excluded.dn, uid = excluded.uid, '
+            'uid_number = excluded.uid_number, attr_hash = excluded.attr_hash, attrs = excluded.attrs',
+            (object_id, dn, uid, uid_number, attr_hash, json.dumps(attrs, sort_keys=True))
+        )
+
+    # Map a user to an existing FreeIPA entry, unless another object id
+    # already has it; returns whether it did
+    def claim_user(self, object_id, dn, uid, uid_number, attr_hash, attrs):
+        try:
+            self.put_user(object_id, dn, uid, uid_number, attr_hash, attrs)
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    # Object id the FreeIPA user uid is synced from, or None
+    def uid_owner(self, uid):
+        row = self.db.execute('SELECT object_id FROM users WHERE uid = ? COLLATE NOCASE', (uid,)).fetchone()
+        return row['object_id'] if row else None
+
+    def set_user_status(self, object_id, status, dn=None):
+        if dn:
+            self.db.execute('UPDATE users SET status = ?, dn = ? WHERE object_id = ?', (status, dn, object_id))
+        else:
+            self.db.execute('UPDATE users SET status = ? WHERE object_id = ?', (status, object_id))
+
+    # Object ids of every synced user that is not preserved yet
+    def user_ids(self):
+        rows = self.db.execute('SELECT object_id FROM users WHERE status != ?', (PRESERVED,))
+        return {row['object_id'] for row in rows}
+
+    # Users FreeIPA refused for good, by object id, with the hash of what
+    # it refused (see sync_user.rejection_hash); skipped until that changes
+    def rejected_users(self):
+        rows = self.db.execute('SELECT object_id, attr_hash FROM rejected_users')
+        return {row['object_id']: row['attr_hash'] for row in rows}
+
+    def reject_user(self, object_id, attr_hash, error):
+        self.db.execute(
+            'INSERT OR REPLACE INTO rejected_users (object_id, attr_hash, error) VALUES (?, ?, ?)',
+            (object_id, attr_hash, error)
+        )
+
+    def clear_rejection(self, object_id):
+        self.db.execute('DELETE FROM rejected_users WHERE object_id = ?', (object_id,))
+
+    def get_group_hash(self, group_id):
+        row = self.db.execute('SELECT member_hash FROM groups WHERE group_id = ?', (group_id,)).fetchone()
+        return row['member_hash'] if row else None
+
+    def set_group_hash(self, group_id, cn, member_hash):
+        self.db.execute(
+            'INSERT OR REPLACE INTO groups (group_id, cn, member_hash) VALUES (?, ?, ?)',
+            (group_id, cn, member_hash)
+        )
+
+    # Users a group resolves to, nested groups included, and the ids of the
+    # groups (itself among them) the set was built from
+    def get_group_members(self, group_id):
+        row = self.db.execute('SELECT * FROM group_members WHERE group_id = ?', (group_id,)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row['groups']), json.loads(row['members'])
+
+    def put_group_members(self, group_id, groups, members):
+        self.db.execute(
+            'INSERT OR REPLACE INTO group_members (group_id, groups, members) VALUES (?, ?, ?)',
+            (group_id, json.dumps(sorted(groups)), json.dumps(members))
+        )
+
+    # Drop the resolved sets built from any of group_ids, or all of them
+    def drop_group_members(self, group_ids=None):
+        if group_ids is None:
+            self.db.execute('DELETE FROM group_members')
+            return
+        group_ids = set(group_ids)
+        rows = self.db.execute('SELECT group_id, groups FROM group_members').fetchall()
+        stale = [(row['group_id'],) for row in rows if group_ids.intersection(json.loads(row['groups']))]
+        self.db.executemany('DELETE FROM group_members WHERE group_id = ?', stale)
+
+    def get_meta(self, key):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row['value'] if row else None
+
+    def set_meta(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# Azure AD user/group FreeIPA sync utility
+# Copyright (c) 2024 Jackson Tong, Creekside Networks LLC.
+
+import re
+import hashlib
+
+import src.aad
+import src.graph
+import src.group_resolver
+import src.logger
+import src.freeIPA
+import src.metrics
+import src.state
+
+# FreeIPA group name for an Azure AD group display name
+def ipa_group_name(display_name):
+    return re.sub(r'[^a-z0-9_.-]+', '-', display_name.lower()).strip('-')
+
+# Stable digest of a set of members
+def membership_hash(members):
+    return hashlib.sha256('\n'.join(sorted(members)).encode('utf-8')).hexdigest()
+
+# FreeIPA uid of a group member from the state store mapping, so it stays
+# stable if the UPN changes. None for members with no account under
+# cn=users: never created (e.g. disabled when first seen) or preserved.
+def member_uid(state, member):
+    record = state.get_user(member['id']) if member.get('id') else None
+    if record is None or record['status'] == src.state.PRESERVED:
+        return None
+    return record['uid'].lower()
+
+# Mirror the Azure AD groups listed in [sync] groups into FreeIPA, with the
+# users of nested groups counted as members. Membership is diffed as sets of
+# member DNs and only the difference is written; groups whose membership hash
+# is unchanged since the last cycle are skipped.
+@src.metrics.timed('group_sync')
+def sync_groups(config, client, ipa, state):
+    group_names = config.get('sync', 'groups')
+    if not group_names:
+        return
+
+    basedn = config.get('freeipa', 'basedn')
+    users_dn = f'cn=users,cn=accounts,{basedn}'
+    groups_dn = f'cn=groups,cn=accounts,{basedn}'
+
+    group_ids = src.aad.get_aad_group_ids_by_names(client, group_names)
+    groups = []
+    for group_name, group_id in group_ids.items():
+        if group_id is None:
+            src.logger.logger.warning(f"Group [{group_name}] not found in Azure AD")
+        else:
+            groups.append({'id': group_id, 'displayName': group_name})
+    concurrency = config.get('azure_ad', 'concurrency')
+    aad_members = src.group_resolver.resolve_group_users(client, state, groups, concurrency)
+
+    conn = ipa.ensure()
+    index = None
+    for group in groups:
+        uids = {member_uid(state, member) for member in aad_members.get(group['id'], [])}
+        uids.discard(None)
+        digest = membership_hash(uids)
+        if state.get_group_hash(group['id']) == digest:
+            continue
+
+        # the user index is only needed once some group actually changed
+        if index is None:
+            index = src.freeIPA.load_user_index(conn, users_dn)
+        wanted = {f"uid={uid},{users_dn}".lower() for uid in uids if index.has_uid(uid)}
+        if len(wanted) < len(uids):
+            src.logger.logger.warning(f"Group '{group['displayName']}': {len(uids) - len(wanted)} "
+                                      f"synced members are missing from FreeIPA")
+
+        cn = ipa_group_name(group['displayName'])
+        group_dn = f"cn={cn},{groups_dn}"
+        if not src.freeIPA.check_group_exists(conn, groups_dn, cn):
+            if not src.freeIPA.create_group(conn, groups_dn, cn, f"Azure AD group {group['displayName']}"):
+                continue
+
+        # only user members are managed; nested groups and others are left alone
+        current = {
+            dn.lower() for dn in src.freeIPA.get_group_members(conn, groups_dn, cn)
+            if dn.lower().endswith(f",{users_dn}".lower())
+        }
+        to_add = wanted - current
+        to_remove = current - wanted
+        if src.freeIPA.modify_group_members(conn, group_dn, add=to_add, remove=to_remove):
+            src.logger.logger.info(f"Group '{cn}': {len(to_add)} members added, {len(to_remove)} removed")
+            # a member created, reactivated or preserved later changes the
+            # digest, so the group is only visited again when that happens
+            state.set_group_hash(group['id'], cn, digest)
+        state.commit()
@@ -4,47 +4,233 @@
 
 # Import functions from src/aad.py
 import src.aad
+import src.graph
 import src.logger
 import src.freeIPA
 import src.configure
+import src.idalloc
+import src.state
+import src.metrics
+import src.deprovision
 
-def sync_users(config, access_token):
-    aad_users = src.aad.get_aad_users(access_token)
-    conn = src.freeIPA.freeIPA_bind(
-        config.get('freeipa', 'server'),
-        config.get('freeipa', 'user'),
-        config.get('freeipa', 'password')
-    )
+# FreeIPA uid of an Azure AD user: the local part of its userPrincipalName
+def aad_uid(user):
+    return user['userPrincipalName'].split('@')[0]
+
+# Synced attributes of an Azure AD user, merged over what was last stored,
+# since delta pages may only carry the properties that changed
+def synced_attributes(user, previous=None):
+    attrs = dict(previous or {})
+    for name in src.state.SYNCED_ATTRIBUTES:
+        if name in user:
+            attrs[name] = user[name] or ''
+    return attrs
+
+# Hash a rejected user is recorded under: its synced attributes and, if it
+# has no FreeIPA account yet, the uid it would get, so a create that failed
+# on the uid is retried once the UPN is fixed in Azure AD
+def rejection_hash(attrs, uid=None):
+    return src.state.attributes_hash(dict(attrs, uid=uid) if uid else attrs)
+
+# Sync Azure AD users into FreeIPA. Users are streamed page by page, so LDAP
+# work on one page overlaps the fetch of the next. With delta_link_file set
+# only the users changed since the last successful cycle are fetched.
+# Known users are tracked by Azure AD object id in the state store; they are
+# only modified when the hash of their synced attributes changed. Passing
+# users (and removed_ids) syncs just those, e.g. from change notifications.
+# Disabled and removed users are deprovisioned per [sync] deprovision; in full
+# mode, and on a delta baseline, removed users are the known ones missing
+# from the listing.
+# Only transient LDAP failures count as failed (and hold back the delta link);
+# users FreeIPA refuses for good are recorded in the state store and skipped
+# until their attributes (or, for users not created yet, their UPN) change.
+# If result is a dict it gets the number of users created, updated, failed
+# and rejected.
+# allocator and index stand in for the configured UID/GID allocator and the
+# FreeIPA user index loaded here.
+def sync_users(config, client, ipa, state, delta_link_file=None, state_dir='.', users=None, removed_ids=None,
+               result=None, allocator=None, index=None):
+    mode = src.deprovision.deprovision_mode(config)
+    delta = None
+    if users is not None:
+        pages = [users]
+    elif delta_link_file:
+        delta = {}
+        pages = src.aad.iter_aad_users_delta(client, src.aad.load_delta_link(delta_link_file), delta)
+    else:
+        pages = src.aad.iter_aad_users(client)
+
+    conn = ipa.ensure()
 
     base_dn = f'cn=users,cn=accounts,{config.get("freeipa", "basedn")}'
     #print (f"Base DN: {base_dn}")
-    next_uid = src.freeIPA.get_next_uid_number(conn, base_dn)
+    if allocator is None:
+        allocator = src.idalloc.get_id_allocator(config, conn, base_dn, state_dir)
+    if index is None and users is not None:
+        # only the users not synced yet are looked up in FreeIPA
+        index = src.freeIPA.load_user_index_for(conn, base_dn, [
+            aad_uid(user) for user in users
+            if user.get('id') and 'userPrincipalName' in user and state.get_user(user['id']) is None
+        ])
+    elif index is None:
+        index = src.freeIPA.load_user_index(conn, base_dn)
     new_users = []
+    failures = 0
+    updated_count = 0
+    rejected = state.rejected_users()
+    rejected_count = 0
+    # a full listing (or delta baseline) shows every user, so the known ones
+    # missing were removed
+    seen = set() if users is None else None
+    disabled_ids = set()
+    enabled_ids = set()
+
+    for page in src.graph.prefetch(pages):
+        pending = {}
+        created = {}
+        updates = {}
+        changed = {}
+        for user in page:
+            object_id = user.get('id')
+            if not object_id:
+                continue
+            if seen is not None:
+                seen.add(object_id)
+            record = state.get_user(object_id)
+            if record is None and 'userPrincipalName' not in user:
+                continue
+            if user.get('accountEnabled') is False:
+                disabled_ids.add(object_id)
+                # no point creating an account only to lock it
+                if record is None and mode != 'none':
+                    continue
+            elif user.get('accountEnabled') and record and record['status'] != src.state.ACTIVE:
+                enabled_ids.add(object_id)
+            attrs = synced_attributes(user, record['attrs'] if record else None)
+            attr_hash = src.state.attributes_hash(attrs)
+            reject_hash = rejection_hash(attrs, None if record else aad_uid(user))
+            if rejected.get(object_id) == reject_hash:
+                src.logger.logger.debug("Skipping user %s, rejected by FreeIPA with these attributes", object_id)
+                continue
+
+            if record is None:
+                uid = aad_uid(user)
+                owner = state.uid_owner(uid)
+                existing = index.get_by_uid(uid) if owner is None else None
+                if existing:
+                    # user already in FreeIPA: take it over, starting from the
+                    # values it has, and bring it up to date
+                    src.logger.logger.debug("Adopting existing FreeIPA user %s for %s", uid, object_id)
+                    current = existing['attrs'] or {}
+                    current_attrs = {name: current.get(ldap_name, '')
+                                     for name, ldap_name in src.state.SYNCED_ATTRIBUTES.items()}
+                    record = {'dn': f"uid={existing['uid']},{base_dn}", 'uid': existing['uid'],
+                              'uid_number': existing['uidNumber'],
+                              'attr_hash': src.state.attributes_hash(current_attrs), 'adopted': current}
+                    if not state.claim_user(object_id, record['dn'], record['uid'], record['uid_number'],
+                                            record['attr_hash'], current_attrs):
+                        # taken by a user of another shard meanwhile
+                        owner = state.uid_owner(uid)
+                if owner is not None:
+                    # e.g. the same UPN local part in another domain: never
+                    # take over (and later lock) another Azure AD user's account
+                    src.logger.logger.warning("Not syncing %s: FreeIPA user %s belongs to %s", object_id, uid, owner)
+                    state.reject_user(object_id, reject_hash, f"uid {uid} belongs to {owner}")
+                    rejected_count += 1
+                    continue
+                if record is None:
+                    if uid in pending:
+                        continue
+                    next_uid = allocator.next_id()
+                    user_data = {
+                        'uid'               : uid,
+                        'password'          : config.get('newuser','password'),
+                        'givenName'         : user.get('givenName', ''),
+                        'sn'                : user.get('surname', ''),
+                        'mail'              : user.get('mail', ''),
+                        'homeDirectory'     : f'/home/{uid}',
+                        'loginShell'        : '/bin/bash',
+                        'displayName'       : user.get('displayName', ''),
+                        'uidNumber'         : next_uid,
+                        'gidNumber'         : next_uid,
+                        'gecos'             : user.get('displayName', ''),
+                        'krbPrincipalName'  : f"{uid}@{config.get('freeipa', 'realm')}",
+                    }
+                    src.logger.logger.debug("Creating user %s with uidNumber %s for %s", uid, next_uid, object_id)
+                    pending[uid] = user_data
+                    created[uid] = (object_id, attrs, attr_hash, reject_hash)
+                    continue
 
-    for user in aad_users:
-        if 'userPrincipalName' in user:
-            uid = user['userPrincipalName'].split('@')[0]
-            if not src.freeIPA.check_user_exists(conn, base_dn, uid):
-                user_data = {
-                    'uid'               : uid,
-                    'password'          : config.get('newuser','password'),
-                    'givenName'         : user.get('givenName', ''),
-                    'sn'                : user.get('surname', ''),
-                    'mail'              : user.get('mail', ''),
-                    'homeDirectory'     : f'/home/{uid}',
-                    'loginShell'        : '/bin/bash',
-                    'displayName'       : user.get('displayName', ''),
-                    'uidNumber'         : next_uid,
-                    'gidNumber'         : next_uid,
-                    'gecos'             : user.get('displayName', ''),
-                    'krbPrincipalName'  : f"{uid}@{config.get('freeipa', 'realm')}",
-                }
-                src.freeIPA.create_user(conn, base_dn, user_data)
-                #print(f"  o {uid} just created, UID/GID: {next_uid}")
-                new_users.append(user_data)
-                next_uid += 1            
+            # known user (the uid is kept even if the UPN changed): only write on change
+            if record['attr_hash'] == attr_hash:
+                src.logger.logger.debug("User %s is unchanged", record['uid'])
+            elif object_id not in updates:
+                ldap_attrs = {src.state.SYNCED_ATTRIBUTES[name]: value for name, value in attrs.items()}
+                if 'adopted' in record:
+                    # what Azure AD leaves empty is kept, only differences are written
+                    ldap_attrs = {name: value for name, value in ldap_attrs.items()
+                                  if value and value != record['adopted'].get(name)}
+                if ldap_attrs:
+                    updates[object_id] = (record['dn'], ldap_attrs)
+                    changed[object_id] = (record, attrs, attr_hash)
+                else:
+                    state.put_user(object_id, record['dn'], record['uid'], record['uid_number'], attr_hash, attrs)
+
+        # the adds of a whole page are kept in flight together
+        failed = {}
+        added = src.freeIPA.create_users(ipa, base_dn, list(pending.values()), failed)
+        src.metrics.USERS_CREATED.inc(len(added))
+        for user_data in added:
+            uid = user_data['uid']
+            object_id, attrs, attr_hash, reject_hash = created[uid]
+            if object_id in rejected:
+                state.clear_rejection(object_id)
+            index.add(uid, user_data['uidNumber'], user_data['mail'])
+            state.put_user(object_id, f"uid={uid},{base_dn}", uid, user_data['uidNumber'], attr_hash, attrs)
+            new_users.append(user_data)
+
+        for uid, ldap_result in failed.items():
+            object_id, attrs, attr_hash, reject_hash = created[uid]
+            if src.freeIPA.is_transient(ldap_result):
+                failures += 1
+            else:
+                state.reject_user(object_id, reject_hash, ldap_result.get('description'))
+                rejected_count += 1
+
+        failed = {}
+        updated = src.freeIPA.update_users(ipa, updates, failed)
+        src.metrics.USERS_UPDATED.inc(len(updated))
+        updated_count += len(updated)
+        for object_id in updated:
+            record, attrs, attr_hash = changed[object_id]
+            state.put_user(object_id, record['dn'], record['uid'], record['uid_number'], attr_hash, attrs)
+            if object_id in rejected:
+                state.clear_rejection(object_id)
+        for object_id, ldap_result in failed.items():
+            if src.freeIPA.is_transient(ldap_result):
+                failures += 1
             else:
-            #    print(f"  - {uid} already exists")
-                pass
+                state.reject_user(object_id, changed[object_id][2], ldap_result.get('description'))
+                rejected_count += 1
+        state.commit()
+
+    if delta is not None and not delta['baseline']:
+        removed_ids = delta['removed']
+    elif seen is not None and mode != 'none':
+        removed_ids = state.user_ids() - seen
+    for object_id in removed_ids or []:
+        src.logger.logger.info("User %s was removed from Azure AD", object_id)
+    failures += src.deprovision.deprovision_users(config, ipa, state, disabled_ids, removed_ids or [], mode)
+    failures += src.deprovision.reactivate_users(ipa, state, base_dn, enabled_ids)
+
+    if delta is not None:
+        # only advance the delta link once every change in it has been applied
+        # or rejected for good
+        if delta['deltaLink'] and not failures:
+            src.aad.save_delta_link(delta_link_file, delta['deltaLink'])
 
-    return new_users 
\ No newline at end of file
+    if result is not None:
+        if rejected_count:
+            src.logger.logger.warning(f"{rejected_count} users rejected, skipped until they change in Azure AD")
+        result.update(created=len(new_users), updated=updated_count, failures=failures, rejected=rejected_count)
+    return new_users
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# Azure AD user/group FreeIPA sync utility
+# Copyright (c) 2024 Jackson Tong, Creekside Networks LLC.
+#
+# One Azure AD tenant / FreeIPA realm pair synced by this process, with its
+# own token cache, Graph client, FreeIPA connection, state store, scheduler
+# and run lock. The single-target setup is the unnamed target; named targets
+# come from [azure_ad:name]/[freeipa:name] pairs and share the process, the
+# HTTP connection pool and the notifier.
+
+import os
+import time
+import threading
+from datetime import datetime
+
+import src.aad
+import src.graph
+import src.logger
+import src.freeIPA
+import src.configure
+import src.metrics
+import src.scheduler
+import src.shard
+import src.state
+import src.sync_user
+import src.sync_group
+
+# Queue the report of the users created in a sync run for email
+def report_new_users(notifier, new_users, target_name=None):
+    report = "New Users Created in FreeIPA:\n\n"
+    report += "{:<12} {:<20} {:<40} {:<10}\n".format("UIDNumber", "UID", "Email", "Password")
+    report += "-" * 84 + "\n"
+    for user in new_users:
+        report += "{:<12} {:<20} {:<40} {:<10}\n".format(user['uidNumber'], user['uid'], user['mail'], user['password'])
+
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    print (report)
+    subject = f"AAD to FreeIPA Sync Report - {timestamp}"
+    if target_name:
+        subject = f"AAD to FreeIPA Sync Report [{target_name}] - {timestamp}"
+    notifier.notify(subject, report)
+
+class SyncTarget:
+
+    def __init__(self, config, root_dir, name=None, session=None):
+        self.name = name
+        self.config = src.configure.TargetConfig(config, name)
+        self.root_dir = root_dir
+        # the unnamed target keeps its files where they always were
+        self.state_dir = os.path.join(root_dir, 'targets', name) if name else root_dir
+        self.session = session
+        self.token_cache_file = os.path.join(root_dir, self.config.get('azure_ad', 'token_cache'))
+        # one cycle at a time, whether scheduled or from change notifications
+        self.lock = threading.Lock()
+        self.run_lock = None
+        self.token_provider = None
+        self.client = None
+        self.ipa = None
+        self.state = None
+        self.ready = False
+        self.scheduler = src.scheduler.get_scheduler(self.config)
+        self.next_run = self.scheduler.first_run()
+
+    @property
+    def label(self):
+        return self.name or 'default'
+
+    # Take the run lock and set up the connections. Raises SchedulerError if
+    # another instance already syncs this FreeIPA; any other failure (e.g.
+    # Azure AD unreachable) leaves the target to finish opening with a later
+    # cycle, picking up where it stopped.
+    def open(self):
+        if self.ready:
+            return self
+        config = self.config
+        os.makedirs(self.state_dir, exist_ok=True)
+        if self.run_lock is None:
+            self.run_lock = src.scheduler.RunLock(src.scheduler.lock_file_path(
+                config.get('sync', 'lock_dir') or src.scheduler.default_lock_dir(),
+                config.get('freeipa', 'server'),
+                config.get('freeipa', 'basedn')
+            )).acquire()
+
+        if self.token_provider is None:
+            self.token_provider = src.aad.TokenProvider(
+                token_cache_file    = self.token_cache_file,
+                tenant_id           = config.get('azure_ad', 'tenant_id'),
+                client_id           = config.get('azure_ad', 'client_id'),
+                client_secret       = config.get('azure_ad', 'client_secret'),
+                scopes              = [config.get('azure_ad', 'scope')]
+            )
+            self.client = src.graph.get_graph_client(config, self.token_provider, self.session)
+
+        # the FreeIPA connection is kept open across cycles
+        if self.ipa is None:
+            self.ipa = src.freeIPA.FreeIPAConnection(
+                config.get('freeipa', 'server'),
+                config.get('freeipa', 'user'),
+                config.get('freeipa', 'password')
+            )
+        # object id to FreeIPA entry mapping and attribute hashes
+        if self.state is None:
+            self.state = src.state.StateStore(os.path.join(self.state_dir, 'aad_freeipa_sync.db'))
+
+        # fetch the first token now and keep it refreshed in the background
+        self.token_provider.start()
+        self.ready = True
+        return self
+
+    # Switch to a reloaded configuration from the next cycle on
+    def reconfigure(self, config):
+        self.config = src.configure.TargetConfig(config, self.name)
+        self.scheduler.interval = self.config.get('sync', 'interval')
+        self.scheduler.jitter = self.config.get('sync', 'jitter')
+        self.scheduler.max_backoff = max(self.config.get('sync', 'max_backoff'), self.scheduler.interval)
+
+    # in delta mode the deltaLink is kept next to the token cache
+    def delta_link_file(self):
+        return f"{self.token_cache_file}.delta" if self.config.get('sync', 'mode') == 'delta' else None
+
+    # Run one sync: all users (or only the given ones), then the groups.
+    # Returns the number of users that failed to sync.
+    def run_cycle(self, notifier, users=None, removed_ids=None):
+        config = self.config
+        with self.lock:
+            src.metrics.TARGET.set(self.name or '')
+            src.logger.set_cycle(f"{self.name + '-' if self.name else ''}{datetime.now().strftime('%Y%m%dT%H%M%S.%f')}")
+            result = {}
+            shards = config.get('sync', 'shards')
+            started = time.monotonic()
+            with src.metrics.PHASE_SECONDS.time(phase='cycle'):
+                if users is None and shards > 1:
+                    new_users = src.shard.sync_users_sharded(config, self.client, self.ipa, self.state,
+                                                             self.delta_link_file(), self.state_dir, shards,
+                                                             result=result)
+                else:
+                    new_users = src.sync_user.sync_users(config, self.client, self.ipa, self.state,
+                                                         self.delta_link_file() if users is None else None,
+                                                         self.state_dir, users=users, removed_ids=removed_ids,
+                                                         result=result)
+                if users is None:
+                    src.sync_group.sync_groups(config, self.client, self.ipa, self.state)
+            elapsed = time.monotonic() - started
+        src.logger.logger.info("Sync cycle of %s finished in %.1f seconds", self.label, elapsed,
+                               extra={'phase': 'cycle', 'seconds': round(elapsed, 3)})
+        if new_users:
+            report_new_users(notifier, new_users, self.name)
+        else:
+            src.logger.logger.info("No new users found.")
+        return result.get('failures', 0)
+
+    # Run a scheduled cycle and work out when the next one is due
+    def run_scheduled(self, notifier):
+        self.scheduler.cycle_started()
+        try:
+            self.open()
+            failures = self.run_cycle(notifier)
+            outcome = src.scheduler.BACKLOG if failures else src.scheduler.OK
+        except src.graph.GraphThrottledError as e:
+            # throttled part way: the rest is picked up by an immediate rerun
+            src.logger.logger.warning(f"Sync cycle of {self.label} throttled by Graph: {e}")
+            outcome = src.scheduler.BACKLOG
+        except Exception as e:
+            src.logger.logger.error(f"An error occurred syncing {self.label}: {e}")
+            outcome = src.scheduler.FAILED
+        self.next_run = self.scheduler.cycle_finished(outcome)
+
+    # Sync the users named in change notifications
+    def handle_changes(self, notifier, object_ids):
+        src.logger.logger.info(f"Change notification for {len(object_ids)} users")
+        try:
+            users, removed_ids = src.aad.get_aad_users_by_ids(self.client, object_ids)
+            self.run_cycle(notifier, users=users, removed_ids=removed_ids)
+        except Exception as e:
+            src.logger.logger.error(f"An error occurred: {e}")
+
+    def close(self):
+        if self.token_provider:
+            self.token_provider.stop()
+        if self.ipa:
+            self.ipa.close()
+        if self.state:
+            self.state.close()
+        if self.run_lock:
+            self.run_lock.release()
+
+# The targets configured: the named [azure_ad:name]/[freeipa:name] pairs, or
+# the single unnamed one. They share one HTTP session for Graph.
+def get_targets(config, root_dir):
+    names = config.target_names()
+    pool_size = max(src.graph.DEFAULT_POOL_SIZE, config.get('azure_ad', 'concurrency') * max(1, len(names)))
+    session = src.graph.new_session(pool_size)
+    return [SyncTarget(config, root_dir, name, session) for name in (names or [None])]